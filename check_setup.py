@@ -16,7 +16,7 @@ def check_imports():
     """Check if the required packages are installed."""
     required_packages = [
         "openai", "numpy", "psycopg2", "pymysql", "pydantic", 
-        "tqdm", "func_timeout", "requests", "httpx", "cryptography"
+        "tqdm", "requests", "httpx", "cryptography"
     ]
     missing_packages = []
     
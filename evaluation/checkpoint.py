@@ -0,0 +1,158 @@
+"""
+Append-only JSONL checkpoints of evaluation runs.
+
+The first line of a checkpoint is a header describing the run (metric, input
+files, dialect, ...); every following line is one execute_model result, written
+as soon as it arrives. An interrupted run can be resumed with the same
+header: finished indices are read back and only the remaining pairs are
+executed. A run started with different settings is refused instead of being
+mixed into the old results.
+"""
+import json
+import os
+from evaluation_utils import score_settings, sort_results, estimate_runtimes
+from result_cache import pair_hashes, load_scored_pairs, store_scored_pairs
+
+
+def read_checkpoint(checkpoint_path):
+    """Return (header, results) of a checkpoint, or (None, []) if it does not exist."""
+    if not os.path.exists(checkpoint_path):
+        return None, []
+    header = None
+    results = []
+    with open(checkpoint_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run may be cut short
+                continue
+            if header is None:
+                header = record
+            else:
+                results.append(record)
+    return header, results
+
+
+def checkpoint_header(settings, args):
+    """Header of an evaluator's checkpoint: its score settings plus the files it scores."""
+    return dict(
+        settings,
+        predicted_sql_path=args.predicted_sql_path,
+        ground_truth_path=args.ground_truth_path,
+        db_root_path=args.db_root_path,
+    )
+
+
+def load_checkpoint(checkpoint_path, header):
+    """Return the finished results of a checkpoint keyed by sql_idx."""
+    checkpoint_header, results = read_checkpoint(checkpoint_path)
+    if checkpoint_header is None:
+        return {}
+    if checkpoint_header != header:
+        raise ValueError(
+            f"Checkpoint {checkpoint_path} was written by a different run: "
+            f"{checkpoint_header} != {header}"
+        )
+    return {result["sql_idx"]: result for result in results}
+
+
+def open_checkpoint(checkpoint_path, header):
+    """Open a checkpoint for appending, writing the header if it is new."""
+    directory_path = os.path.dirname(checkpoint_path)
+    if directory_path and not os.path.exists(directory_path):
+        os.makedirs(directory_path, exist_ok=True)
+    checkpoint_file = open(checkpoint_path, "a+")
+    checkpoint_file.seek(0, os.SEEK_END)
+    if checkpoint_file.tell() == 0:
+        checkpoint_file.write(json.dumps(header) + "\n")
+    else:
+        # start on a fresh line if the previous run stopped mid-write
+        checkpoint_file.seek(checkpoint_file.tell() - 1)
+        if checkpoint_file.read(1) != "\n":
+            checkpoint_file.write("\n")
+    checkpoint_file.flush()
+    return checkpoint_file
+
+
+def write_checkpoint(checkpoint_file, result):
+    checkpoint_file.write(json.dumps(result) + "\n")
+    checkpoint_file.flush()
+
+
+def load_runtime_history(checkpoint_path):
+    """Per-query latencies ({sql_idx: seconds}) recorded in an earlier run's checkpoint."""
+    _, results = read_checkpoint(checkpoint_path)
+    return {result["sql_idx"]: result["time"] for result in results if "time" in result}
+
+
+def schedule_estimates(args, ground_truths, db_places):
+    """Runtime estimates for --schedule longest (None for the other schedules)."""
+    if args.schedule != "longest":
+        return None
+    history = None
+    if args.runtime_history_path:
+        history = load_runtime_history(args.runtime_history_path)
+    return estimate_runtimes(ground_truths, db_places, args.sql_dialect, history)
+
+
+class ResumableRun:
+    """
+    Results of one evaluator run with the --checkpoint_path and
+    --results_store_path handling all evaluators share: results finished by
+    an interrupted run are read back from the checkpoint, pairs unchanged
+    since they were stored are taken from the results store, every new result
+    is appended to the checkpoint as it arrives (add) and written to the
+    store at the end (finish), unless it failed for a transient reason
+    (timeouts, locked or unreadable databases) and must run again next time.
+    skip_indices holds the pairs not to execute.
+    """
+
+    def __init__(self, metric, args, query_pairs, db_places):
+        settings = score_settings(metric, args)
+        self.results = []
+        self.checkpoint_file = None
+        self.store_path = args.results_store_path
+        done_results = {}
+        if args.checkpoint_path:
+            header = checkpoint_header(settings, args)
+            done_results = load_checkpoint(args.checkpoint_path, header)
+            self.checkpoint_file = open_checkpoint(args.checkpoint_path, header)
+            self.results.extend(done_results.values())
+            print(f"Resuming with {len(done_results)} finished queries from {args.checkpoint_path}")
+        self.reused_results = {}
+        if self.store_path:
+            self.hashes = pair_hashes(query_pairs, db_places, args.sql_dialect, settings)
+            self.reused_results = {
+                i: result
+                for i, result in load_scored_pairs(self.store_path, self.hashes).items()
+                if i not in done_results
+            }
+            self.results.extend(self.reused_results.values())
+            print(f"Reusing {len(self.reused_results)} unchanged results from {self.store_path}")
+        self.skip_indices = {**done_results, **self.reused_results}
+
+    def add(self, result):
+        self.results.append(result)
+        if self.checkpoint_file is not None:
+            write_checkpoint(self.checkpoint_file, result)
+
+    def finish(self):
+        """Close the checkpoint, store the new results and return all results by sql_idx."""
+        if self.checkpoint_file is not None:
+            self.checkpoint_file.close()
+        if self.store_path:
+            store_scored_pairs(
+                self.store_path,
+                self.hashes,
+                [
+                    result
+                    for result in self.results
+                    if result["sql_idx"] not in self.reused_results
+                    and not result.get("transient_error")
+                ],
+            )
+        return sort_results(self.results)
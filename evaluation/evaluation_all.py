@@ -0,0 +1,358 @@
+"""
+Single-pass evaluator: every pred/gold pair is executed once and EX, Soft-F1
+and R-VES are all computed from the same fetched (distinct) results. Only
+pairs that pass EX are re-run for the R-VES timing iterations, and a
+prediction whose result outgrows the Soft-F1 caps is re-read uncapped for EX,
+so EX always matches evaluation_ex.py.
+"""
+import sys
+import time
+import argparse
+from evaluation_utils import (
+    fetch_results,
+    package_sqls,
+    sort_results,
+    print_data,
+    QueryTimeout,
+    is_deterministic_error,
+    ResultTooLarge,
+    ROW_CAP_FACTOR,
+    MAX_RESULT_BYTES,
+    SQLITE_MODES,
+    MAX_SNAPSHOT_BYTES,
+    run_pairs_parallel,
+)
+from checkpoint import ResumableRun, schedule_estimates
+from evaluation_ex import calculate_ex, compute_acc_by_diff
+from evaluation_f1 import get_f1_function, compute_f1_by_diff
+from evaluation_ves import (
+    measure_time_ratio,
+    measure_vm_step_ratio,
+    compute_reward,
+    compute_ves_by_diff,
+    WARMUP_NUM,
+    MIN_ITERATIONS,
+)
+
+
+def execute_model(
+    predicted_sql,
+    ground_truth,
+    db_place,
+    idx,
+    iterate_num,
+    meta_time_out,
+    sql_dialect,
+    gold_cache_path=None,
+    row_cap_factor=ROW_CAP_FACTOR,
+    max_result_bytes=MAX_RESULT_BYTES,
+    f1_engine="numpy",
+    f1_pairing="compat",
+    warmup_num=WARMUP_NUM,
+    sampling="fixed",
+    min_iterations=MIN_ITERATIONS,
+    ves_metric="time",
+    gold_profile_path=None,
+    gold_profile_max_age=None,
+):
+    start_time = time.perf_counter()
+    error = None
+    # timeouts and errors of the database rather than the SQL (not kept in the results store)
+    transient_error = False
+    ex, f1, reward = 0, 0, 0
+    try:
+        try:
+            predicted_res, ground_truth_res = fetch_results(
+                predicted_sql,
+                ground_truth,
+                db_place,
+                sql_dialect,
+                gold_cache_path,
+                deadline=time.perf_counter() + meta_time_out,
+                row_cap_factor=row_cap_factor,
+                max_result_bytes=max_result_bytes,
+            )
+            ex = calculate_ex(predicted_res, ground_truth_res)
+            f1 = get_f1_function(f1_engine, f1_pairing)(predicted_res, ground_truth_res)
+        except ResultTooLarge:
+            # Soft-F1 scores 0 like evaluation_f1.py, but EX must not depend on
+            # the caps: decide it on the uncapped distinct rows like evaluation_ex.py
+            error = "ResultTooLarge"
+            predicted_res, ground_truth_res = fetch_results(
+                predicted_sql,
+                ground_truth,
+                db_place,
+                sql_dialect,
+                gold_cache_path,
+                deadline=time.perf_counter() + meta_time_out,
+                match_gold=True,
+            )
+            ex = calculate_ex(predicted_res, ground_truth_res)
+        if ex == 1 and iterate_num > 0 and ves_metric == "vm_steps":
+            time_ratio = measure_vm_step_ratio(
+                predicted_sql,
+                ground_truth,
+                db_place,
+                deadline=time.perf_counter() + meta_time_out,
+            )
+            reward = compute_reward(time_ratio)
+        elif ex == 1 and iterate_num > 0:
+            time_ratio = measure_time_ratio(
+                predicted_sql,
+                ground_truth,
+                db_place,
+                iterate_num,
+                sql_dialect,
+                deadline=time.perf_counter() + meta_time_out * iterate_num,
+                warmup_num=warmup_num,
+                sampling=sampling,
+                min_iterations=min_iterations,
+                timer="server" if ves_metric == "server_time" else "client",
+                gold_profile_path=gold_profile_path,
+                gold_profile_max_age=gold_profile_max_age,
+            )
+            reward = compute_reward(time_ratio)
+    except KeyboardInterrupt:
+        sys.exit(0)
+    except QueryTimeout:
+        transient_error = True
+        error = "QueryTimeout"
+    except Exception as e:
+        transient_error = not is_deterministic_error(e)
+        error = type(e).__name__  # possibly len(query) > 512 or not executable
+    result = {
+        "sql_idx": idx,
+        "ex": ex,
+        "f1": f1,
+        "reward": reward,
+        "time": time.perf_counter() - start_time,
+        "error": error,
+        "transient_error": transient_error,
+    }
+    return result
+
+
+def run_sqls_parallel(
+    sqls,
+    db_places,
+    num_cpus=1,
+    iterate_num=100,
+    meta_time_out=30.0,
+    sql_dialect="SQLite",
+    gold_cache_path=None,
+    schedule="question",
+    row_cap_factor=ROW_CAP_FACTOR,
+    max_result_bytes=MAX_RESULT_BYTES,
+    f1_engine="numpy",
+    f1_pairing="compat",
+    warmup_num=WARMUP_NUM,
+    sampling="fixed",
+    min_iterations=MIN_ITERATIONS,
+    ves_metric="time",
+    gold_profile_path=None,
+    gold_profile_max_age=None,
+    sqlite_mode="file",
+    skip_indices=(),
+    estimates=None,
+    callback=None,
+    max_snapshot_bytes=MAX_SNAPSHOT_BYTES,
+):
+    def task_args(i):
+        predicted_sql, ground_truth = sqls[i]
+        return (
+            predicted_sql,
+            ground_truth,
+            db_places[i],
+            i,
+            iterate_num,
+            meta_time_out,
+            sql_dialect,
+            gold_cache_path,
+            row_cap_factor,
+            max_result_bytes,
+            f1_engine,
+            f1_pairing,
+            warmup_num,
+            sampling,
+            min_iterations,
+            ves_metric,
+            gold_profile_path,
+            gold_profile_max_age,
+        )
+
+    return run_pairs_parallel(
+        execute_model,
+        task_args,
+        db_places,
+        num_cpus,
+        schedule,
+        sqlite_mode,
+        skip_indices,
+        estimates,
+        callback,
+        sql_dialect,
+        max_snapshot_bytes,
+    )
+
+
+def split_results(exec_results):
+    """Split the combined results into the per-metric lists the compute_*_by_diff helpers expect."""
+    ex_results = [{"sql_idx": res["sql_idx"], "res": res["ex"]} for res in exec_results]
+    f1_results = [{"sql_idx": res["sql_idx"], "res": res["f1"]} for res in exec_results]
+    ves_results = [
+        {"sql_idx": res["sql_idx"], "reward": res["reward"]} for res in exec_results
+    ]
+    return ex_results, f1_results, ves_results
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument(
+        "--predicted_sql_path", type=str, required=True, default=""
+    )
+    args_parser.add_argument("--ground_truth_path", type=str, required=True, default="")
+    args_parser.add_argument("--db_root_path", type=str, required=True, default="")
+    args_parser.add_argument("--num_cpus", type=int, default=1)
+    args_parser.add_argument("--meta_time_out", type=float, default=30.0)
+    args_parser.add_argument("--diff_json_path", type=str, default="")
+    args_parser.add_argument("--sql_dialect", type=str, default="SQLite")
+    args_parser.add_argument("--output_log_path", type=str, default="SQLite")
+    # R-VES timing iterations per correct pair; 0 skips R-VES
+    args_parser.add_argument("--iterate_num", type=int, default=100)
+    # SQLite file caching gold results across runs (SQLite dialect only)
+    args_parser.add_argument("--gold_cache_path", type=str, default="")
+    # "db" groups pairs by database so each worker keeps its databases warm,
+    # "longest" starts the pairs expected to run longest first
+    args_parser.add_argument(
+        "--schedule", type=str, default="question", choices=["question", "db", "longest"]
+    )
+    # checkpoint of an earlier run whose per-query latencies guide the "longest" schedule
+    args_parser.add_argument("--runtime_history_path", type=str, default="")
+    # predicted results may hold this many times the gold row count; 0 disables the cap
+    args_parser.add_argument("--row_cap_factor", type=int, default=ROW_CAP_FACTOR)
+    # upper bound on the size of one predicted result in MB; 0 disables the cap
+    args_parser.add_argument(
+        "--max_result_mb", type=int, default=MAX_RESULT_BYTES // (1024 * 1024)
+    )
+    # "python" runs the reference row-by-row Soft-F1 implementation
+    args_parser.add_argument(
+        "--f1_engine", type=str, default="numpy", choices=["numpy", "python"]
+    )
+    # "sorted" pairs rows deterministically instead of in set iteration order
+    args_parser.add_argument(
+        "--f1_pairing", type=str, default="compat", choices=["compat", "sorted"]
+    )
+    # untimed pred/gold runs before the R-VES timing iterations
+    args_parser.add_argument("--warmup_num", type=int, default=WARMUP_NUM)
+    # "adaptive" stops timing once the reward bucket is settled; iterate_num becomes the ceiling
+    args_parser.add_argument(
+        "--ves_sampling", type=str, default="fixed", choices=["fixed", "adaptive"]
+    )
+    args_parser.add_argument("--min_iterations", type=int, default=MIN_ITERATIONS)
+    # "vm_steps" rewards the SQLite VM-step ratio of a single run instead of timing,
+    # "server_time" times MySQL/PostgreSQL queries with EXPLAIN ANALYZE on the server
+    args_parser.add_argument(
+        "--ves_metric", type=str, default="time", choices=["time", "vm_steps", "server_time"]
+    )
+    # SQLite file keeping gold timing profiles across runs and models (SQLite dialect only)
+    args_parser.add_argument("--gold_profile_path", type=str, default="")
+    # re-measure gold timing profiles older than this many seconds; 0 keeps them forever
+    args_parser.add_argument("--gold_profile_max_age", type=float, default=0)
+    # "readonly" opens SQLite files immutable with mmap and rejects writes,
+    # "memory" runs every query against a per-worker in-memory copy of the database
+    # (pairs are then always scheduled by database, see schedule_batches)
+    args_parser.add_argument(
+        "--sqlite_mode", type=str, default="file", choices=list(SQLITE_MODES)
+    )
+    # most MB of databases a worker keeps as in-memory snapshots with --sqlite_mode memory
+    args_parser.add_argument(
+        "--max_snapshot_mb", type=int, default=MAX_SNAPSHOT_BYTES // (1024 * 1024)
+    )
+    # JSONL file every result is appended to; rerunning with it resumes the run
+    args_parser.add_argument("--checkpoint_path", type=str, default="")
+    # results store (SQLite); pairs unchanged since they were stored are not executed again
+    args_parser.add_argument("--results_store_path", type=str, default="")
+    args = args_parser.parse_args()
+    if args.ves_metric == "vm_steps" and args.sql_dialect != "SQLite":
+        args_parser.error("--ves_metric vm_steps is only available for SQLite")
+    if args.ves_metric == "server_time" and args.sql_dialect == "SQLite":
+        args_parser.error("--ves_metric server_time is only available for MySQL and PostgreSQL")
+
+    pred_queries, db_paths = package_sqls(
+        args.predicted_sql_path,
+        args.db_root_path,
+        mode='pred'
+    )
+    # generate ground truth sqls:
+    gt_queries, db_paths_gt = package_sqls(
+        args.ground_truth_path,
+        args.db_root_path,
+        mode="gt",
+    )
+
+    # Handle case where prediction file has fewer queries than ground truth
+    if len(pred_queries) < len(gt_queries):
+        print(f"WARNING: Prediction file contains only {len(pred_queries)} queries, but ground truth has {len(gt_queries)}")
+        print(f"Will evaluate only the first {len(pred_queries)} queries")
+        gt_queries = gt_queries[:len(pred_queries)]
+        db_paths_gt = db_paths_gt[:len(pred_queries)]
+
+    query_pairs = list(zip(pred_queries, gt_queries))
+
+    run = ResumableRun("all", args, query_pairs, db_paths_gt)
+    estimates = schedule_estimates(args, gt_queries, db_paths_gt)
+
+    run_sqls_parallel(
+        query_pairs,
+        db_places=db_paths_gt,
+        num_cpus=args.num_cpus,
+        iterate_num=args.iterate_num,
+        meta_time_out=args.meta_time_out,
+        sql_dialect=args.sql_dialect,
+        gold_cache_path=args.gold_cache_path,
+        schedule=args.schedule,
+        row_cap_factor=args.row_cap_factor,
+        max_result_bytes=args.max_result_mb * 1024 * 1024,
+        f1_engine=args.f1_engine,
+        f1_pairing=args.f1_pairing,
+        warmup_num=args.warmup_num,
+        sampling=args.ves_sampling,
+        min_iterations=args.min_iterations,
+        ves_metric=args.ves_metric,
+        gold_profile_path=args.gold_profile_path,
+        gold_profile_max_age=args.gold_profile_max_age,
+        sqlite_mode=args.sqlite_mode,
+        skip_indices=run.skip_indices,
+        estimates=estimates,
+        callback=run.add,
+        max_snapshot_bytes=args.max_snapshot_mb * 1024 * 1024,
+    )
+    exec_result = run.finish()
+    ex_results, f1_results, ves_results = split_results(exec_result)
+
+    print("start calculate EX")
+    simple_acc, moderate_acc, challenging_acc, acc, count_lists = compute_acc_by_diff(
+        ex_results, args.diff_json_path
+    )
+    score_lists = [simple_acc, moderate_acc, challenging_acc, acc]
+    print_data(score_lists, count_lists, metric="EX", result_log_file=args.output_log_path)
+
+    print("start calculate Soft F1")
+    simple_f1, moderate_f1, challenging_f1, f1, count_lists = compute_f1_by_diff(
+        f1_results, args.diff_json_path
+    )
+    score_lists = [simple_f1, moderate_f1, challenging_f1, f1]
+    print_data(score_lists, count_lists, metric="Soft-F1", result_log_file=args.output_log_path)
+
+    if args.iterate_num > 0:
+        print("start calculate R-VES")
+        simple_ves, moderate_ves, challenging_ves, ves, count_lists = compute_ves_by_diff(
+            ves_results, args.diff_json_path
+        )
+        score_lists = [simple_ves, moderate_ves, challenging_ves, ves]
+        print_data(score_lists, count_lists, metric="R-VES", result_log_file=args.output_log_path)
+    print(
+        "==========================================================================================="
+    )
+    print(f"Finished EX, Soft-F1 and R-VES evaluation for {args.sql_dialect} on Mini Dev set")
+    print("\n\n")
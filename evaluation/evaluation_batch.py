@@ -0,0 +1,210 @@
+"""
+Batch EX evaluation of several prediction files (e.g. one per model) against
+the same gold file.
+
+The gold file and the difficulty file are read once, the query pairs of all
+models go through a single run_sqls_parallel call (one worker pool, one
+connection pool per worker), and gold results are shared through a gold cache
+so every gold query runs once for the whole batch rather than once per model.
+One print_data table is printed per model, followed by a leaderboard.
+"""
+import os
+import glob
+import shutil
+import argparse
+import tempfile
+from evaluation_utils import (
+    load_jsonl,
+    package_sqls,
+    sort_results,
+    print_data,
+    SQLITE_MODES,
+    MAX_SNAPSHOT_BYTES,
+)
+from checkpoint import schedule_estimates
+from evaluation_ex import run_sqls_parallel, compute_acc_by_diff
+
+
+def find_prediction_files(patterns):
+    """Expand directories (to the .json files they contain) and glob patterns."""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(sorted(glob.glob(os.path.join(pattern, "*.json"))))
+        else:
+            paths.extend(sorted(glob.glob(pattern)))
+    # keep the first occurrence of files matched by several patterns
+    return list(dict.fromkeys(paths))
+
+
+def model_names(predicted_sql_paths):
+    """
+    Name every prediction file by its basename, or by its path relative to
+    the other files of the same basename where basenames collide.
+    """
+    basenames = [
+        os.path.splitext(os.path.basename(path))[0] for path in predicted_sql_paths
+    ]
+    names = []
+    for path, basename in zip(predicted_sql_paths, basenames):
+        same_name = [
+            os.path.abspath(other)
+            for other, other_basename in zip(predicted_sql_paths, basenames)
+            if other_basename == basename
+        ]
+        if len(same_name) == 1:
+            names.append(basename)
+        else:
+            common = os.path.commonpath(same_name)
+            names.append(os.path.splitext(os.path.relpath(os.path.abspath(path), common))[0])
+    return names
+
+
+def print_leaderboard(leaderboard, result_log_file=None):
+    lines = [
+        "{:50} {:<12} {:<12} {:<12} {:<12}".format(
+            "model", "simple", "moderate", "challenging", "total"
+        )
+    ]
+    for name, score_lists in sorted(leaderboard, key=lambda item: item[1][3], reverse=True):
+        lines.append(
+            "{:50} {:<12.2f} {:<12.2f} {:<12.2f} {:<12.2f}".format(name, *score_lists)
+        )
+    print("======================================    Leaderboard (EX)    =====================================")
+    print("\n".join(lines))
+    if result_log_file is not None:
+        with open(result_log_file, "a") as log_file:
+            log_file.write("Leaderboard (EX)\n")
+            log_file.write("\n".join(lines) + "\n\n")
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    # directories and/or glob patterns of prediction files, e.g. "llm/exp_result/sql_output_kg/*.json"
+    args_parser.add_argument("--predicted_sql_paths", type=str, nargs="+", required=True)
+    args_parser.add_argument("--ground_truth_path", type=str, required=True, default="")
+    args_parser.add_argument("--db_root_path", type=str, required=True, default="")
+    args_parser.add_argument("--num_cpus", type=int, default=1)
+    args_parser.add_argument("--meta_time_out", type=float, default=30.0)
+    args_parser.add_argument("--diff_json_path", type=str, default="")
+    args_parser.add_argument("--sql_dialect", type=str, default="SQLite")
+    args_parser.add_argument("--output_log_path", type=str, default=None)
+    # SQLite file caching gold results across runs; a temporary one is shared by the batch otherwise
+    args_parser.add_argument("--gold_cache_path", type=str, default="")
+    # "db" groups pairs of all models by database so each worker keeps its databases warm,
+    # "longest" starts the pairs expected to run longest first
+    args_parser.add_argument(
+        "--schedule", type=str, default="db", choices=["question", "db", "longest"]
+    )
+    # checkpoint of an earlier run whose per-query latencies guide the "longest" schedule
+    args_parser.add_argument("--runtime_history_path", type=str, default="")
+    # "digest" compares order-independent result digests instead of row sets
+    args_parser.add_argument(
+        "--ex_compare", type=str, default="rows", choices=["rows", "digest"]
+    )
+    # "readonly" opens SQLite files immutable with mmap and rejects writes,
+    # "memory" runs every query against a per-worker in-memory copy of the database
+    # (pairs are then always scheduled by database, see schedule_batches)
+    args_parser.add_argument(
+        "--sqlite_mode", type=str, default="file", choices=list(SQLITE_MODES)
+    )
+    # most MB of databases a worker keeps as in-memory snapshots with --sqlite_mode memory
+    args_parser.add_argument(
+        "--max_snapshot_mb", type=int, default=MAX_SNAPSHOT_BYTES // (1024 * 1024)
+    )
+    # SQLite file recording every predicted query's outcome, shared across models (digest mode)
+    args_parser.add_argument("--execution_cache_path", type=str, default="")
+    args = args_parser.parse_args()
+    if args.execution_cache_path and args.ex_compare != "digest":
+        args_parser.error("--execution_cache_path requires --ex_compare digest")
+
+    predicted_sql_paths = find_prediction_files(args.predicted_sql_paths)
+    if not predicted_sql_paths:
+        args_parser.error("no prediction files matched --predicted_sql_paths")
+    print(f"Evaluating {len(predicted_sql_paths)} prediction files")
+
+    gt_queries, db_paths_gt = package_sqls(
+        args.ground_truth_path,
+        args.db_root_path,
+        mode="gt",
+    )
+    try:
+        diff_contents = load_jsonl(args.diff_json_path)
+    except Exception:
+        diff_contents = None
+
+    # all models' pairs in one list; model k owns indices offsets[k] .. offsets[k] + counts[k]
+    query_pairs, db_places, offsets, counts = [], [], [], []
+    for predicted_sql_path in predicted_sql_paths:
+        pred_queries, _ = package_sqls(predicted_sql_path, args.db_root_path, mode="pred")
+        if len(pred_queries) < len(gt_queries):
+            print(f"WARNING: {predicted_sql_path} contains only {len(pred_queries)} queries, but ground truth has {len(gt_queries)}")
+        pairs = list(zip(pred_queries, gt_queries))
+        offsets.append(len(query_pairs))
+        counts.append(len(pairs))
+        query_pairs.extend(pairs)
+        db_places.extend(db_paths_gt[: len(pairs)])
+
+    estimates = None
+    question_estimates = schedule_estimates(args, gt_queries, db_paths_gt)
+    if question_estimates is not None:
+        # estimates are per question, so every model's copy of a question gets the same one
+        estimates = [
+            question_estimates[i] for count in counts for i in range(count)
+        ]
+
+    gold_cache_path = args.gold_cache_path
+    temp_dir = None
+    if not gold_cache_path and args.sql_dialect == "SQLite":
+        temp_dir = tempfile.mkdtemp(prefix="bird_gold_cache_")
+        gold_cache_path = os.path.join(temp_dir, "gold_cache.sqlite")
+
+    try:
+        exec_result = run_sqls_parallel(
+            query_pairs,
+            db_places=db_places,
+            num_cpus=args.num_cpus,
+            meta_time_out=args.meta_time_out,
+            sql_dialect=args.sql_dialect,
+            gold_cache_path=gold_cache_path,
+            schedule=args.schedule,
+            ex_compare=args.ex_compare,
+            sqlite_mode=args.sqlite_mode,
+            execution_cache_path=args.execution_cache_path,
+            estimates=estimates,
+            max_snapshot_bytes=args.max_snapshot_mb * 1024 * 1024,
+        )
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    exec_result = sort_results(exec_result)
+
+    leaderboard = []
+    for name, offset, count in zip(model_names(predicted_sql_paths), offsets, counts):
+        model_results = {
+            result["sql_idx"] - offset: dict(result, sql_idx=result["sql_idx"] - offset)
+            for result in exec_result
+            if offset <= result["sql_idx"] < offset + count
+        }
+        missing = [i for i in range(count) if i not in model_results]
+        if missing:
+            # a worker that died takes its batch with it; score those pairs as failures
+            print(f"WARNING: no result for {len(missing)} queries of {name}, counted as wrong: {missing}")
+        model_results = [
+            model_results.get(i, {"sql_idx": i, "res": 0, "error": "missing"})
+            for i in range(count)
+        ]
+        print(f"start calculate EX for {name}")
+        simple_acc, moderate_acc, challenging_acc, acc, count_lists = compute_acc_by_diff(
+            model_results, args.diff_json_path, diff_contents
+        )
+        score_lists = [simple_acc, moderate_acc, challenging_acc, acc]
+        print_data(score_lists, count_lists, metric=f"EX {name}", result_log_file=args.output_log_path)
+        leaderboard.append((name, score_lists))
+
+    print_leaderboard(leaderboard, args.output_log_path)
+    print(
+        "==========================================================================================="
+    )
+    print(f"Finished batch EX evaluation of {len(predicted_sql_paths)} models for {args.sql_dialect} on Mini Dev set")
+    print("\n\n")
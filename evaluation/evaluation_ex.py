@@ -1,18 +1,20 @@
 import sys
+import time
 import argparse
-import multiprocessing as mp
-from func_timeout import func_timeout, FunctionTimedOut
 from evaluation_utils import (
     load_jsonl,
     execute_sql,
+    fetch_digests,
     package_sqls,
     sort_results,
     print_data,
+    QueryTimeout,
+    is_deterministic_error,
+    SQLITE_MODES,
+    MAX_SNAPSHOT_BYTES,
+    run_pairs_parallel,
 )
-
-
-def result_callback(result):
-    exec_result.append(result)
+from checkpoint import ResumableRun, schedule_estimates
 
 
 def calculate_ex(predicted_res, ground_truth_res):
@@ -23,55 +25,129 @@ def calculate_ex(predicted_res, ground_truth_res):
 
 
 def execute_model(
-    predicted_sql, ground_truth, db_place, idx, meta_time_out, sql_dialect
+    predicted_sql,
+    ground_truth,
+    db_place,
+    idx,
+    meta_time_out,
+    sql_dialect,
+    gold_cache_path=None,
+    ex_compare="rows",
+    float_precision=None,
+    null_value=None,
+    execution_cache_path=None,
 ):
+    start_time = time.perf_counter()
+    error = None
+    # timeouts and errors of the database rather than the SQL (not kept in the results store)
+    transient_error = False
+    # the database interrupts whatever is still running once this passes
+    deadline = start_time + meta_time_out
     try:
-        res = func_timeout(
-            meta_time_out,
-            execute_sql,
-            args=(predicted_sql, ground_truth, db_place, sql_dialect, calculate_ex),
-        )
+        if ex_compare == "digest":
+            predicted_digest, ground_truth_digest = fetch_digests(
+                predicted_sql,
+                ground_truth,
+                db_place,
+                sql_dialect,
+                gold_cache_path,
+                deadline,
+                float_precision,
+                null_value,
+                execution_cache_path,
+                meta_time_out,
+            )
+            res = 1 if predicted_digest == ground_truth_digest else 0
+        else:
+            res = execute_sql(
+                predicted_sql,
+                ground_truth,
+                db_place,
+                sql_dialect,
+                calculate_ex,
+                gold_cache_path,
+                deadline,
+                match_gold=True,
+            )
     except KeyboardInterrupt:
         sys.exit(0)
-    except FunctionTimedOut:
+    except QueryTimeout:
+        transient_error = True
         result = [(f"timeout",)]
+        error = "QueryTimeout"
         res = 0
     except Exception as e:
+        transient_error = not is_deterministic_error(e)
         result = [(f"error",)]  # possibly len(query) > 512 or not executable
+        # errors replayed from the execution cache keep their original class
+        error = getattr(e, "error_class", type(e).__name__)
         res = 0
-    result = {"sql_idx": idx, "res": res}
+    result = {
+        "sql_idx": idx,
+        "res": res,
+        "time": time.perf_counter() - start_time,
+        "error": error,
+        "transient_error": transient_error,
+    }
     return result
 
 
 def run_sqls_parallel(
-    sqls, db_places, num_cpus=1, meta_time_out=30.0, sql_dialect="SQLite"
+    sqls,
+    db_places,
+    num_cpus=1,
+    meta_time_out=30.0,
+    sql_dialect="SQLite",
+    gold_cache_path=None,
+    schedule="question",
+    ex_compare="rows",
+    float_precision=None,
+    null_value=None,
+    sqlite_mode="file",
+    skip_indices=(),
+    estimates=None,
+    execution_cache_path=None,
+    callback=None,
+    max_snapshot_bytes=MAX_SNAPSHOT_BYTES,
 ):
-    pool = mp.Pool(processes=num_cpus)
-    for i, sql_pair in enumerate(sqls):
-
-        predicted_sql, ground_truth = sql_pair
-        pool.apply_async(
-            execute_model,
-            args=(
-                predicted_sql,
-                ground_truth,
-                db_places[i],
-                i,
-                meta_time_out,
-                sql_dialect,
-            ),
-            callback=result_callback,
+    def task_args(i):
+        predicted_sql, ground_truth = sqls[i]
+        return (
+            predicted_sql,
+            ground_truth,
+            db_places[i],
+            i,
+            meta_time_out,
+            sql_dialect,
+            gold_cache_path,
+            ex_compare,
+            float_precision,
+            null_value,
+            execution_cache_path,
         )
-    pool.close()
-    pool.join()
 
+    return run_pairs_parallel(
+        execute_model,
+        task_args,
+        db_places,
+        num_cpus,
+        schedule,
+        sqlite_mode,
+        skip_indices,
+        estimates,
+        callback,
+        sql_dialect,
+        max_snapshot_bytes,
+    )
 
-def compute_acc_by_diff(exec_results, diff_json_path):
+
+def compute_acc_by_diff(exec_results, diff_json_path, diff_contents=None):
     num_queries = len(exec_results)
     results = [res["res"] for res in exec_results]
     
     try:
-        contents = load_jsonl(diff_json_path)
+        # callers scoring several result lists can load the diff file once
+        contents = diff_contents if diff_contents is not None else load_jsonl(diff_json_path)
         print(f"Successfully loaded diff file with {len(contents)} entries")
     except Exception as e:
         print(f"Error loading diff file: {e}")
@@ -144,8 +220,41 @@ if __name__ == "__main__":
     args_parser.add_argument("--diff_json_path", type=str, default="")
     args_parser.add_argument("--sql_dialect", type=str, default="SQLite")
     args_parser.add_argument("--output_log_path", type=str, default="SQLite")
+    # SQLite file caching gold results across runs (SQLite dialect only)
+    args_parser.add_argument("--gold_cache_path", type=str, default="")
+    # "db" groups pairs by database so each worker keeps its databases warm,
+    # "longest" starts the pairs expected to run longest first
+    args_parser.add_argument(
+        "--schedule", type=str, default="question", choices=["question", "db", "longest"]
+    )
+    # checkpoint of an earlier run whose per-query latencies guide the "longest" schedule
+    args_parser.add_argument("--runtime_history_path", type=str, default="")
+    # "digest" compares order-independent result digests instead of row sets
+    args_parser.add_argument(
+        "--ex_compare", type=str, default="rows", choices=["rows", "digest"]
+    )
+    # digest normalization: round floats to this many digits / compare NULL as this string
+    args_parser.add_argument("--float_precision", type=int, default=None)
+    args_parser.add_argument("--null_value", type=str, default=None)
+    # "readonly" opens SQLite files immutable with mmap and rejects writes,
+    # "memory" runs every query against a per-worker in-memory copy of the database
+    # (pairs are then always scheduled by database, see schedule_batches)
+    args_parser.add_argument(
+        "--sqlite_mode", type=str, default="file", choices=list(SQLITE_MODES)
+    )
+    # most MB of databases a worker keeps as in-memory snapshots with --sqlite_mode memory
+    args_parser.add_argument(
+        "--max_snapshot_mb", type=int, default=MAX_SNAPSHOT_BYTES // (1024 * 1024)
+    )
+    # JSONL file every result is appended to; rerunning with it resumes the run
+    args_parser.add_argument("--checkpoint_path", type=str, default="")
+    # results store (SQLite); pairs unchanged since they were stored are not executed again
+    args_parser.add_argument("--results_store_path", type=str, default="")
+    # SQLite file recording every predicted query's outcome, shared across models (digest mode)
+    args_parser.add_argument("--execution_cache_path", type=str, default="")
     args = args_parser.parse_args()
-    exec_result = []
+    if args.execution_cache_path and args.ex_compare != "digest":
+        args_parser.error("--execution_cache_path requires --ex_compare digest")
 
     pred_queries, db_paths = package_sqls(
         args.predicted_sql_path,
@@ -168,14 +277,28 @@ if __name__ == "__main__":
 
     query_pairs = list(zip(pred_queries, gt_queries))
 
+    run = ResumableRun("ex", args, query_pairs, db_paths_gt)
+    estimates = schedule_estimates(args, gt_queries, db_paths_gt)
+
     run_sqls_parallel(
         query_pairs,
         db_places=db_paths_gt,
         num_cpus=args.num_cpus,
         meta_time_out=args.meta_time_out,
         sql_dialect=args.sql_dialect,
+        gold_cache_path=args.gold_cache_path,
+        schedule=args.schedule,
+        ex_compare=args.ex_compare,
+        float_precision=args.float_precision,
+        null_value=args.null_value,
+        sqlite_mode=args.sqlite_mode,
+        skip_indices=run.skip_indices,
+        estimates=estimates,
+        execution_cache_path=args.execution_cache_path,
+        callback=run.add,
+        max_snapshot_bytes=args.max_snapshot_mb * 1024 * 1024,
     )
-    exec_result = sort_results(exec_result)
+    exec_result = run.finish()
     print("start calculate EX")
     simple_acc, moderate_acc, challenging_acc, acc, count_lists = compute_acc_by_diff(
         exec_result, args.diff_json_path
@@ -1,14 +1,26 @@
 import sys
+import time
 import argparse
-import multiprocessing as mp
-from func_timeout import func_timeout, FunctionTimedOut
+import functools
+import itertools
+import numpy as np
+from result_digest import encode_value
 from evaluation_utils import (
     load_jsonl,
     execute_sql,
     package_sqls,
     sort_results,
     print_data,
+    QueryTimeout,
+    is_deterministic_error,
+    ResultTooLarge,
+    ROW_CAP_FACTOR,
+    MAX_RESULT_BYTES,
+    SQLITE_MODES,
+    MAX_SNAPSHOT_BYTES,
+    run_pairs_parallel,
 )
+from checkpoint import ResumableRun, schedule_estimates
 
 
 def calculate_row_match(predicted_row, ground_truth_row):
@@ -101,61 +113,211 @@ def calculate_f1_score(predicted, ground_truth):
     return f1_score
 
 
-def result_callback(result):
-    exec_result.append(result)
+# Row pairs compared per NumPy block; bounds the (rows x cols x cols) match cube
+F1_BLOCK_ROWS = 65536
+
+
+def intern_rows(predicted_rows, ground_truth_rows):
+    """
+    Replace every cell of both results by an integer code, equal values
+    sharing a code. Returns two (rows x columns) arrays, or None when the rows
+    of either result do not all have the same non-zero width.
+    """
+    shapes = []
+    for rows in (predicted_rows, ground_truth_rows):
+        widths = {len(row) for row in rows}
+        if len(widths) != 1 or 0 in widths:
+            return None
+        shapes.append((len(rows), widths.pop()))
+    pred_cells = list(itertools.chain.from_iterable(predicted_rows))
+    truth_cells = list(itertools.chain.from_iterable(ground_truth_rows))
+    lookup = {
+        value: code
+        for code, value in enumerate(dict.fromkeys(itertools.chain(pred_cells, truth_cells)))
+    }
+    pred_codes = np.fromiter(
+        map(lookup.__getitem__, pred_cells), dtype=np.int64, count=len(pred_cells)
+    ).reshape(shapes[0])
+    truth_codes = np.fromiter(
+        map(lookup.__getitem__, truth_cells), dtype=np.int64, count=len(truth_cells)
+    ).reshape(shapes[1])
+    return pred_codes, truth_codes
+
+
+def row_sort_key(row):
+    return tuple(encode_value(value) for value in row)
+
+
+def calculate_f1_score_vectorized(predicted, ground_truth, pairing="compat"):
+    """
+    NumPy implementation of calculate_f1_score.
+
+    Cell values are interned into integer codes and the per-row matches of
+    calculate_row_match are computed as array operations over all row pairs
+    at once instead of tuple membership loops.
+
+    Args:
+    predicted (list of tuples): Predicted results from SQL query.
+    ground_truth (list of tuples): Actual results expected (ground truth).
+    pairing (str): "compat" pairs rows in set iteration order exactly like
+        calculate_f1_score; "sorted" pairs them in canonical sorted order so
+        the score does not depend on hash ordering.
+
+    Returns:
+    float: The calculated F1 score.
+    """
+    if not predicted and not ground_truth:
+        return 1.0
+
+    # Drop duplicates
+    predicted = list(set(predicted)) if predicted else []
+    ground_truth = list(set(ground_truth))
+    if pairing == "sorted":
+        predicted.sort(key=row_sort_key)
+        ground_truth.sort(key=row_sort_key)
+
+    num_pairs = min(len(predicted), len(ground_truth))
+    tp, fp, fn = 0.0, 0.0, 0.0
+    if num_pairs:
+        interned = intern_rows(predicted[:num_pairs], ground_truth[:num_pairs])
+        if interned is None:
+            # ragged or empty rows: leave them to the reference implementation
+            return calculate_f1_score(predicted, ground_truth)
+        pred_codes, truth_codes = interned
+        total_columns = truth_codes.shape[1]
+        matches, truth_only = 0, 0
+        for start in range(0, num_pairs, F1_BLOCK_ROWS):
+            pred_block = pred_codes[start : start + F1_BLOCK_ROWS]
+            truth_block = truth_codes[start : start + F1_BLOCK_ROWS]
+            # equal[i, j, k]: cell j of predicted row i equals cell k of gold row i
+            equal = pred_block[:, :, None] == truth_block[:, None, :]
+            matches += int(equal.any(axis=2).sum())
+            truth_only += int((~equal.any(axis=1)).sum())
+        tp = matches / total_columns
+        fp = (pred_codes.size - matches) / total_columns
+        fn = truth_only / total_columns
+
+    # rows only in the predicted results / only in the ground truth results
+    fp += max(len(predicted) - len(ground_truth), 0)
+    fn += max(len(ground_truth) - len(predicted), 0)
+
+    precision = tp / (tp + fp) if tp + fp > 0 else 0
+    recall = tp / (tp + fn) if tp + fn > 0 else 0
+
+    f1_score = (
+        2 * precision * recall / (precision + recall) if precision + recall > 0 else 0
+    )
+    return f1_score
+
+
+def get_f1_function(f1_engine="numpy", f1_pairing="compat"):
+    if f1_engine == "python":
+        return calculate_f1_score
+    return functools.partial(calculate_f1_score_vectorized, pairing=f1_pairing)
 
 
 def execute_model(
-    predicted_sql, ground_truth, db_place, idx, meta_time_out, sql_dialect
+    predicted_sql,
+    ground_truth,
+    db_place,
+    idx,
+    meta_time_out,
+    sql_dialect,
+    gold_cache_path=None,
+    row_cap_factor=ROW_CAP_FACTOR,
+    max_result_bytes=MAX_RESULT_BYTES,
+    f1_engine="numpy",
+    f1_pairing="compat",
 ):
+    start_time = time.perf_counter()
+    error = None
+    # timeouts and errors of the database rather than the SQL (not kept in the results store)
+    transient_error = False
+    # the database interrupts whatever is still running once this passes
+    deadline = start_time + meta_time_out
     try:
-        res = func_timeout(
-            meta_time_out,
-            execute_sql,
-            args=(
-                predicted_sql,
-                ground_truth,
-                db_place,
-                sql_dialect,
-                calculate_f1_score,
-            ),
+        res = execute_sql(
+            predicted_sql,
+            ground_truth,
+            db_place,
+            sql_dialect,
+            get_f1_function(f1_engine, f1_pairing),
+            gold_cache_path,
+            deadline,
+            row_cap_factor=row_cap_factor,
+            max_result_bytes=max_result_bytes,
         )
     except KeyboardInterrupt:
         sys.exit(0)
-    except FunctionTimedOut:
-        result = [(f"timeout",)]
+    except QueryTimeout:
+        transient_error = True
+        error = "QueryTimeout"
+        res = 0
+    except ResultTooLarge:
+        error = "ResultTooLarge"
         res = 0
     except Exception as e:
-        result = [(f"error",)]  # possibly len(query) > 512 or not executable
+        transient_error = not is_deterministic_error(e)
+        error = type(e).__name__  # possibly len(query) > 512 or not executable
         res = 0
-    # print(result)
-    # result = str(set([ret[0] for ret in result]))
-    result = {"sql_idx": idx, "res": res}
+    result = {
+        "sql_idx": idx,
+        "res": res,
+        "time": time.perf_counter() - start_time,
+        "error": error,
+        "transient_error": transient_error,
+    }
     # print(result)
     return result
 
 
 def run_sqls_parallel(
-    sqls, db_places, num_cpus=1, meta_time_out=30.0, sql_dialect="SQLite"
+    sqls,
+    db_places,
+    num_cpus=1,
+    meta_time_out=30.0,
+    sql_dialect="SQLite",
+    gold_cache_path=None,
+    schedule="question",
+    row_cap_factor=ROW_CAP_FACTOR,
+    max_result_bytes=MAX_RESULT_BYTES,
+    f1_engine="numpy",
+    f1_pairing="compat",
+    sqlite_mode="file",
+    skip_indices=(),
+    estimates=None,
+    callback=None,
+    max_snapshot_bytes=MAX_SNAPSHOT_BYTES,
 ):
-    pool = mp.Pool(processes=num_cpus)
-    for i, sql_pair in enumerate(sqls):
-
-        predicted_sql, ground_truth = sql_pair
-        pool.apply_async(
-            execute_model,
-            args=(
-                predicted_sql,
-                ground_truth,
-                db_places[i],
-                i,
-                meta_time_out,
-                sql_dialect,
-            ),
-            callback=result_callback,
+    def task_args(i):
+        predicted_sql, ground_truth = sqls[i]
+        return (
+            predicted_sql,
+            ground_truth,
+            db_places[i],
+            i,
+            meta_time_out,
+            sql_dialect,
+            gold_cache_path,
+            row_cap_factor,
+            max_result_bytes,
+            f1_engine,
+            f1_pairing,
         )
-    pool.close()
-    pool.join()
+
+    return run_pairs_parallel(
+        execute_model,
+        task_args,
+        db_places,
+        num_cpus,
+        schedule,
+        sqlite_mode,
+        skip_indices,
+        estimates,
+        callback,
+        sql_dialect,
+        max_snapshot_bytes,
+    )
 
 
 def compute_f1_by_diff(exec_results, diff_json_path):
@@ -230,8 +392,44 @@ if __name__ == "__main__":
     args_parser.add_argument("--diff_json_path", type=str, default="")
     args_parser.add_argument("--sql_dialect", type=str, default="SQLite")
     args_parser.add_argument("--output_log_path", type=str, default="SQLite")
+    # SQLite file caching gold results across runs (SQLite dialect only)
+    args_parser.add_argument("--gold_cache_path", type=str, default="")
+    # "db" groups pairs by database so each worker keeps its databases warm,
+    # "longest" starts the pairs expected to run longest first
+    args_parser.add_argument(
+        "--schedule", type=str, default="question", choices=["question", "db", "longest"]
+    )
+    # checkpoint of an earlier run whose per-query latencies guide the "longest" schedule
+    args_parser.add_argument("--runtime_history_path", type=str, default="")
+    # predicted results may hold this many times the gold row count; 0 disables the cap
+    args_parser.add_argument("--row_cap_factor", type=int, default=ROW_CAP_FACTOR)
+    # upper bound on the size of one predicted result in MB; 0 disables the cap
+    args_parser.add_argument(
+        "--max_result_mb", type=int, default=MAX_RESULT_BYTES // (1024 * 1024)
+    )
+    # "python" runs the reference row-by-row implementation
+    args_parser.add_argument(
+        "--f1_engine", type=str, default="numpy", choices=["numpy", "python"]
+    )
+    # "sorted" pairs rows deterministically instead of in set iteration order
+    args_parser.add_argument(
+        "--f1_pairing", type=str, default="compat", choices=["compat", "sorted"]
+    )
+    # "readonly" opens SQLite files immutable with mmap and rejects writes,
+    # "memory" runs every query against a per-worker in-memory copy of the database
+    # (pairs are then always scheduled by database, see schedule_batches)
+    args_parser.add_argument(
+        "--sqlite_mode", type=str, default="file", choices=list(SQLITE_MODES)
+    )
+    # most MB of databases a worker keeps as in-memory snapshots with --sqlite_mode memory
+    args_parser.add_argument(
+        "--max_snapshot_mb", type=int, default=MAX_SNAPSHOT_BYTES // (1024 * 1024)
+    )
+    # JSONL file every result is appended to; rerunning with it resumes the run
+    args_parser.add_argument("--checkpoint_path", type=str, default="")
+    # results store (SQLite); pairs unchanged since they were stored are not executed again
+    args_parser.add_argument("--results_store_path", type=str, default="")
     args = args_parser.parse_args()
-    exec_result = []
 
     pred_queries, db_paths = package_sqls(
         args.predicted_sql_path,
@@ -247,14 +445,28 @@ if __name__ == "__main__":
 
     query_pairs = list(zip(pred_queries, gt_queries))
 
+    run = ResumableRun("f1", args, query_pairs, db_paths_gt)
+    estimates = schedule_estimates(args, gt_queries, db_paths_gt)
+
     run_sqls_parallel(
         query_pairs,
         db_places=db_paths_gt,
         num_cpus=args.num_cpus,
         meta_time_out=args.meta_time_out,
         sql_dialect=args.sql_dialect,
+        gold_cache_path=args.gold_cache_path,
+        schedule=args.schedule,
+        row_cap_factor=args.row_cap_factor,
+        max_result_bytes=args.max_result_mb * 1024 * 1024,
+        f1_engine=args.f1_engine,
+        f1_pairing=args.f1_pairing,
+        sqlite_mode=args.sqlite_mode,
+        skip_indices=run.skip_indices,
+        estimates=estimates,
+        callback=run.add,
+        max_snapshot_bytes=args.max_snapshot_mb * 1024 * 1024,
     )
-    exec_result = sort_results(exec_result)
+    exec_result = run.finish()
 
     print("start calculate Soft F1")
     simple_acc, moderate_acc, challenging_acc, acc, count_lists = compute_f1_by_diff(
@@ -1,8 +1,31 @@
 import json
 import psycopg2
 import pymysql
+import pymysql.cursors
 import sqlite3
 import os
+import math
+import time
+import threading
+import multiprocessing as mp
+from multiprocessing.util import Finalize
+from result_cache import (
+    database_fingerprint,
+    load_gold_result,
+    store_gold_result,
+    load_gold_digest,
+    store_gold_digest,
+    load_execution,
+    store_execution,
+    close_caches,
+)
+from result_digest import (
+    ResultDigest,
+    make_normalizer,
+    normalizer_tag,
+    pack_row_hashes,
+    unpack_row_hashes,
+)
 
 def load_jsonl(file_path):
     """
@@ -113,8 +136,96 @@ def connect_mysql():
             return db
 
 
-def connect_db(sql_dialect, db_path):
-    if sql_dialect == "SQLite":
+# How worker processes open SQLite databases, set per worker by init_worker:
+# "file" reads the database file directly, "readonly" opens it as an
+# immutable read-only URI with memory-mapped I/O, and "memory" runs every
+# query against an in-memory snapshot of the file taken on first use.
+SQLITE_MODES = ("file", "readonly", "memory")
+_sqlite_mode = "file"
+# Bytes of database files a worker keeps as in-memory snapshots at most; the
+# least recently used snapshots go first, but the one in use is always kept
+MAX_SNAPSHOT_BYTES = 1 << 30
+_max_snapshot_bytes = MAX_SNAPSHOT_BYTES
+# Bytes of a read-only database file mapped into memory
+READONLY_MMAP_SIZE = 1 << 30
+# Page cache of a read-only connection, in KiB (negative cache_size)
+READONLY_CACHE_KIB = 64 * 1024
+
+# Authorizer actions that modify a database or attach another one
+SQLITE_WRITE_ACTIONS = frozenset(
+    getattr(sqlite3, name)
+    for name in (
+        "SQLITE_INSERT",
+        "SQLITE_UPDATE",
+        "SQLITE_DELETE",
+        "SQLITE_CREATE_INDEX",
+        "SQLITE_CREATE_TABLE",
+        "SQLITE_CREATE_TEMP_INDEX",
+        "SQLITE_CREATE_TEMP_TABLE",
+        "SQLITE_CREATE_TEMP_TRIGGER",
+        "SQLITE_CREATE_TEMP_VIEW",
+        "SQLITE_CREATE_TRIGGER",
+        "SQLITE_CREATE_VIEW",
+        "SQLITE_CREATE_VTABLE",
+        "SQLITE_DROP_INDEX",
+        "SQLITE_DROP_TABLE",
+        "SQLITE_DROP_TEMP_INDEX",
+        "SQLITE_DROP_TEMP_TABLE",
+        "SQLITE_DROP_TEMP_TRIGGER",
+        "SQLITE_DROP_TEMP_VIEW",
+        "SQLITE_DROP_TRIGGER",
+        "SQLITE_DROP_VIEW",
+        "SQLITE_DROP_VTABLE",
+        "SQLITE_ALTER_TABLE",
+        "SQLITE_REINDEX",
+        "SQLITE_ANALYZE",
+        "SQLITE_ATTACH",
+        "SQLITE_DETACH",
+    )
+)
+
+
+def deny_writes(action, arg1, arg2, db_name, trigger_name):
+    """sqlite3 authorizer rejecting every statement that would change a database."""
+    if action in SQLITE_WRITE_ACTIONS:
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+
+def connect_sqlite_readonly(db_path):
+    """
+    Open a SQLite database as an immutable read-only URI: no file locks are
+    taken, pages are read through mmap, and predicted SQL cannot write.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro&immutable=1", uri=True)
+    conn.execute(f"PRAGMA mmap_size={READONLY_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{READONLY_CACHE_KIB}")
+    conn.set_authorizer(deny_writes)
+    return conn
+
+
+def connect_sqlite_snapshot(db_path):
+    """
+    Copy a SQLite database into a private in-memory database with the backup
+    API. The snapshot is shared by every question on that database, so it
+    rejects writes just like a read-only file.
+    """
+    source = sqlite3.connect(f"file:{db_path}?mode=ro&immutable=1", uri=True)
+    try:
+        conn = sqlite3.connect(":memory:")
+        source.backup(conn)
+    finally:
+        source.close()
+    conn.set_authorizer(deny_writes)
+    return conn
+
+
+def connect_db(sql_dialect, db_path, sqlite_mode="file"):
+    if sql_dialect == "SQLite" and sqlite_mode == "memory":
+        conn = connect_sqlite_snapshot(db_path)
+    elif sql_dialect == "SQLite" and sqlite_mode == "readonly":
+        conn = connect_sqlite_readonly(db_path)
+    elif sql_dialect == "SQLite":
         conn = sqlite3.connect(db_path)
     elif sql_dialect == "MySQL":
         conn = connect_mysql()
@@ -125,19 +236,677 @@ def connect_db(sql_dialect, db_path):
     return conn
 
 
-def execute_sql(predicted_sql, ground_truth, db_path, sql_dialect, calculate_func):
-    conn = connect_db(sql_dialect, db_path)
-    # Connect to the database
-    cursor = conn.cursor()
-    cursor.execute(predicted_sql)
-    predicted_res = cursor.fetchall()
-    cursor.execute(ground_truth)
-    ground_truth_res = cursor.fetchall()
-    conn.close()
+# Connections kept open by this process, keyed by (sql_dialect, db_path,
+# SQLite mode). Every multiprocessing worker has its own copy of this module,
+# so a worker reuses its connections across all the tasks it runs and nothing
+# is shared between processes. Entries are kept in least recently used order.
+_connection_pool = {}
+# Size of the database file behind every in-memory snapshot in the pool
+_snapshot_bytes = {}
+
+
+def pool_key(sql_dialect, db_path):
+    return (sql_dialect, db_path, _sqlite_mode if sql_dialect == "SQLite" else None)
+
+
+def get_connection(sql_dialect, db_path):
+    """Return a pooled connection for (sql_dialect, db_path), opening it on first use."""
+    key = pool_key(sql_dialect, db_path)
+    conn = _connection_pool.pop(key, None)
+    if conn is None:
+        conn = connect_db(sql_dialect, db_path, _sqlite_mode)
+        if key[2] == "memory":
+            _snapshot_bytes[key] = os.path.getsize(db_path)
+    _connection_pool[key] = conn
+    if key[2] == "memory":
+        evict_snapshots()
+    return conn
+
+
+def evict_snapshots(max_bytes=None):
+    """
+    Close the least recently used in-memory snapshots until the rest fit in
+    max_bytes (the worker's limit, see init_worker, by default).
+    """
+    if max_bytes is None:
+        max_bytes = _max_snapshot_bytes
+    snapshot_keys = [key for key in _connection_pool if key[2] == "memory"]
+    total = sum(_snapshot_bytes.get(key, 0) for key in snapshot_keys)
+    # the most recently used snapshot is the one being handed out
+    for key in snapshot_keys[:-1]:
+        if total <= max_bytes:
+            break
+        total -= _snapshot_bytes.get(key, 0)
+        discard_connection(key[0], key[1], key[2])
+
+
+def release_connection(conn, sql_dialect, db_path):
+    """
+    End whatever transaction the last query opened so the pooled connection
+    can be reused; connections that cannot be reset are dropped from the pool.
+    """
+    if _connection_pool.get(pool_key(sql_dialect, db_path)) is not conn:
+        return
+    try:
+        conn.rollback()
+    except Exception:
+        discard_connection(sql_dialect, db_path)
+
+
+def discard_connection(sql_dialect, db_path, sqlite_mode=None):
+    """Drop a connection that can no longer be reset from the pool and close it."""
+    if sqlite_mode is None:
+        key = pool_key(sql_dialect, db_path)
+    else:
+        key = (sql_dialect, db_path, sqlite_mode)
+    conn = _connection_pool.pop(key, None)
+    _snapshot_bytes.pop(key, None)
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def close_connections():
+    for conn in _connection_pool.values():
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _connection_pool.clear()
+    _snapshot_bytes.clear()
+
+
+def init_worker(sqlite_mode="file", max_snapshot_bytes=MAX_SNAPSHOT_BYTES):
+    """
+    multiprocessing.Pool initializer: sets how this worker opens SQLite
+    databases (see SQLITE_MODES) and how many bytes of in-memory snapshots it
+    keeps in "memory" mode. Pool workers leave through os._exit, which
+    skips atexit handlers, so the pooled connections are closed by a Finalize
+    hook that runs when the worker shuts down.
+    """
+    global _sqlite_mode, _max_snapshot_bytes
+    if sqlite_mode not in SQLITE_MODES:
+        raise ValueError(f"Unsupported SQLite mode: {sqlite_mode}")
+    _sqlite_mode = sqlite_mode
+    _max_snapshot_bytes = max_snapshot_bytes
+    Finalize(None, close_connections, exitpriority=10)
+    Finalize(None, close_caches, exitpriority=10)
+
+
+def current_sqlite_mode():
+    """The SQLite mode this worker was initialized with (see init_worker)."""
+    return _sqlite_mode
+
+
+class QueryTimeout(Exception):
+    """Raised when a query was stopped by the database for running past its deadline."""
+
+
+class CachedExecutionError(Exception):
+    """Raised in place of the error a predicted query is recorded to have failed with."""
+
+    def __init__(self, error_class):
+        super().__init__(f"{error_class} (recorded in the execution cache)")
+        self.error_class = error_class
+
+
+# SQLite virtual-machine instructions between two deadline checks
+SQLITE_PROGRESS_STEPS = 1000
+# Extra seconds MySQL gets to honour max_execution_time before KILL QUERY is sent
+MYSQL_KILL_GRACE = 1.0
+
+
+def kill_mysql_query(thread_id):
+    """Stop the statement running on another MySQL session from a separate connection."""
+    try:
+        conn = connect_mysql()
+        try:
+            conn.cursor().execute(f"KILL QUERY {int(thread_id)}")
+        finally:
+            conn.close()
+    except Exception:
+        pass
+
+
+def arm_deadline(conn, sql_dialect, deadline):
+    """
+    Make the database itself stop the next statement once deadline (a
+    time.perf_counter() value) passes: a progress handler for SQLite,
+    statement_timeout for PostgreSQL, and max_execution_time backed by a
+    KILL QUERY watchdog for MySQL (max_execution_time only covers SELECT).
+    Returns the watchdog timer, if any, for disarm_deadline.
+    """
+    remaining_ms = max(1, int((deadline - time.perf_counter()) * 1000))
+    if sql_dialect == "SQLite":
+        conn.set_progress_handler(
+            lambda: 1 if time.perf_counter() >= deadline else 0,
+            SQLITE_PROGRESS_STEPS,
+        )
+    elif sql_dialect == "PostgreSQL":
+        # reverted by the rollback in release_connection
+        conn.cursor().execute("SET statement_timeout = %s", (remaining_ms,))
+    elif sql_dialect == "MySQL":
+        conn.cursor().execute("SET SESSION max_execution_time = %s", (remaining_ms,))
+        watchdog = threading.Timer(
+            remaining_ms / 1000 + MYSQL_KILL_GRACE,
+            kill_mysql_query,
+            args=(conn.thread_id(),),
+        )
+        watchdog.daemon = True
+        watchdog.start()
+        return watchdog
+    return None
+
+
+def disarm_deadline(conn, sql_dialect, watchdog=None):
+    if sql_dialect == "SQLite":
+        conn.set_progress_handler(None, SQLITE_PROGRESS_STEPS)
+    if watchdog is not None:
+        watchdog.cancel()
+
+
+def run_query(
+    conn, cursor, sql, sql_dialect, deadline=None, return_time=False, fetch=None
+):
+    """
+    Execute sql and fetch its rows, with cursor.fetchall() unless another
+    fetch function is given. With a deadline the query is interrupted inside
+    the database when time runs out and QueryTimeout is raised, so a runaway
+    query never keeps the worker busy. With return_time the rows are returned
+    together with the execute + fetch time in nanoseconds.
+    """
+    watchdog = None
+    if deadline is not None:
+        if time.perf_counter() >= deadline:
+            raise QueryTimeout("no time left to run the query")
+        watchdog = arm_deadline(conn, sql_dialect, deadline)
+    try:
+        start_time = time.perf_counter_ns()
+        cursor.execute(sql)
+        rows = fetch(cursor) if fetch is not None else cursor.fetchall()
+        exec_time = time.perf_counter_ns() - start_time
+    except Exception as e:
+        if deadline is not None and time.perf_counter() >= deadline:
+            raise QueryTimeout("query was interrupted at its deadline") from e
+        raise
+    finally:
+        if deadline is not None:
+            disarm_deadline(conn, sql_dialect, watchdog)
+    if return_time:
+        return rows, exec_time
+    return rows
+
+
+class ResultTooLarge(Exception):
+    """Raised when a predicted query returns more rows or bytes than its cap allows."""
+
+
+# Rows pulled from a cursor per fetchmany() call
+FETCH_BATCH_SIZE = 1000
+# A predicted result may hold this many times the gold row count...
+ROW_CAP_FACTOR = 100
+# ...but is always allowed at least this many rows
+MIN_ROW_CAP = 10000
+# Rough bound on the row data a single predicted result may hold
+MAX_RESULT_BYTES = 256 * 1024 * 1024
+
+
+def estimate_row_bytes(row):
+    size = 0
+    for value in row:
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        else:
+            size += 8
+    return size
+
+
+def iter_rows(cursor, batch_size=FETCH_BATCH_SIZE, deadline=None):
+    """
+    Yield the rows of cursor in fetchmany() batches. A server-side cursor runs
+    every batch as its own statement (a PostgreSQL FETCH gets a fresh
+    statement_timeout), so the deadline is also checked between batches.
+    """
+    while True:
+        if deadline is not None and time.perf_counter() >= deadline:
+            raise QueryTimeout("result was still streaming at the deadline")
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def fetch_capped(cursor, max_rows=None, max_bytes=None, deadline=None):
+    """
+    Stream the distinct rows of a result, raising ResultTooLarge once they
+    exceed a cap. EX and Soft-F1 both compare row sets, so duplicates are
+    dropped as they arrive and never count against the caps. Rows keep their
+    first-seen order, so "compat" Soft-F1 pairs them as it did the full result.
+    """
+    seen = {}
+    total_bytes = 0
+    for row in iter_rows(cursor, deadline=deadline):
+        if row in seen:
+            continue
+        seen[row] = None
+        if max_rows is not None and len(seen) > max_rows:
+            raise ResultTooLarge(f"result has more than {max_rows} distinct rows")
+        if max_bytes is not None:
+            total_bytes += estimate_row_bytes(row)
+            if total_bytes > max_bytes:
+                raise ResultTooLarge(f"result is larger than {max_bytes} bytes")
+    return list(seen)
+
+
+def fetch_matching(cursor, ground_truth_set, deadline=None):
+    """
+    Stream the distinct rows of a predicted result for an EX comparison. The
+    first row that is not in the gold result settles EX as a mismatch, so
+    reading stops there; that row is kept in the returned list so
+    set(predicted) != set(gold) still holds. Memory stays bounded by the size
+    of the gold result however many rows the prediction produces.
+    """
+    seen = set()
+    for row in iter_rows(cursor, deadline=deadline):
+        seen.add(row)
+        if row not in ground_truth_set:
+            break
+    return list(seen)
+
+
+def open_stream_cursor(conn, sql_dialect):
+    """
+    Open a cursor whose rows are read incrementally. psycopg2 and pymysql
+    buffer the whole result client-side by default, so those dialects use a
+    server-side (named) cursor and an unbuffered SSCursor respectively.
+    """
+    if sql_dialect == "PostgreSQL":
+        cursor = conn.cursor(name="bird_predicted")
+        cursor.itersize = FETCH_BATCH_SIZE
+        return cursor
+    if sql_dialect == "MySQL":
+        return conn.cursor(pymysql.cursors.SSCursor)
+    return conn.cursor()
+
+
+def close_stream_cursor(cursor, sql_dialect, db_path):
+    if sql_dialect == "MySQL":
+        # closing an unbuffered cursor reads whatever is left of the result, so
+        # a result abandoned half way is dropped together with its connection
+        try:
+            finished = cursor.fetchone() is None
+        except Exception:
+            finished = False
+        if not finished:
+            discard_connection(sql_dialect, db_path)
+            return
+    try:
+        cursor.close()
+    except Exception:
+        pass
+
+
+def fetch_gold_result(
+    conn, cursor, ground_truth, db_path, sql_dialect, gold_cache_path=None, deadline=None
+):
+    """
+    Run a gold query, or load its rows from the gold result cache when one is
+    configured and holds an entry for the current version of the database.
+    """
+    db_fingerprint = None
+    if gold_cache_path:
+        db_fingerprint = database_fingerprint(sql_dialect, db_path)
+    if db_fingerprint is not None:
+        ground_truth_res = load_gold_result(
+            gold_cache_path, ground_truth, db_path, db_fingerprint
+        )
+        if ground_truth_res is not None:
+            return ground_truth_res
+    ground_truth_res = run_query(conn, cursor, ground_truth, sql_dialect, deadline)
+    if db_fingerprint is not None:
+        store_gold_result(
+            gold_cache_path, ground_truth, db_path, db_fingerprint, ground_truth_res
+        )
+    return ground_truth_res
+
+
+def fetch_results(
+    predicted_sql,
+    ground_truth,
+    db_path,
+    sql_dialect,
+    gold_cache_path=None,
+    deadline=None,
+    match_gold=False,
+    row_cap_factor=ROW_CAP_FACTOR,
+    max_result_bytes=MAX_RESULT_BYTES,
+):
+    """
+    Execute a pred/gold pair once and return both result sets.
+
+    The gold result is fetched first and the predicted rows are then streamed.
+    With match_gold only the distinct predicted rows needed for an EX verdict
+    are read (see fetch_matching). Otherwise the distinct predicted rows are
+    returned, and there may be at most max(MIN_ROW_CAP, row_cap_factor * gold
+    rows) of them holding max_result_bytes bytes before ResultTooLarge is
+    raised; a falsy cap disables it.
+    """
+    conn = get_connection(sql_dialect, db_path)
+    try:
+        cursor = conn.cursor()
+        ground_truth_res = fetch_gold_result(
+            conn, cursor, ground_truth, db_path, sql_dialect, gold_cache_path, deadline
+        )
+        cursor.close()
+        if match_gold:
+            ground_truth_set = set(ground_truth_res)
+
+            def fetch(pred_cursor):
+                return fetch_matching(pred_cursor, ground_truth_set, deadline)
+
+        else:
+            max_rows = None
+            if row_cap_factor:
+                max_rows = max(MIN_ROW_CAP, row_cap_factor * len(ground_truth_res))
+
+            def fetch(pred_cursor):
+                return fetch_capped(
+                    pred_cursor, max_rows, max_result_bytes or None, deadline
+                )
+
+        pred_cursor = open_stream_cursor(conn, sql_dialect)
+        try:
+            predicted_res = run_query(
+                conn, pred_cursor, predicted_sql, sql_dialect, deadline, fetch=fetch
+            )
+        finally:
+            close_stream_cursor(pred_cursor, sql_dialect, db_path)
+    finally:
+        release_connection(conn, sql_dialect, db_path)
+    return predicted_res, ground_truth_res
+
+
+def fetch_gold_digest(
+    conn,
+    cursor,
+    ground_truth,
+    db_path,
+    sql_dialect,
+    gold_cache_path=None,
+    deadline=None,
+    normalize=None,
+    options="",
+):
+    """
+    Return the digest and row-hash set of a gold result. The gold rows are
+    hashed as they stream in and never held in memory, and with a gold cache
+    the digest is loaded instead of running the query at all.
+    """
+    db_fingerprint = None
+    if gold_cache_path:
+        db_fingerprint = database_fingerprint(sql_dialect, db_path)
+    if db_fingerprint is not None:
+        cached = load_gold_digest(
+            gold_cache_path, ground_truth, db_path, db_fingerprint, options
+        )
+        if cached is not None:
+            return cached[0], unpack_row_hashes(cached[1])
+    digest = ResultDigest(normalize=normalize)
+    run_query(
+        conn,
+        cursor,
+        ground_truth,
+        sql_dialect,
+        deadline,
+        fetch=lambda gold_cursor: digest.update_rows(iter_rows(gold_cursor, deadline=deadline)),
+    )
+    if db_fingerprint is not None:
+        store_gold_digest(
+            gold_cache_path,
+            ground_truth,
+            db_path,
+            db_fingerprint,
+            options,
+            digest.hexdigest(),
+            pack_row_hashes(digest.row_hashes),
+        )
+    return digest.hexdigest(), digest.row_hashes
+
+
+def fetch_matching_digest(cursor, ground_truth_hashes, normalize=None, deadline=None):
+    """
+    Digest a predicted result as it streams in. Like fetch_matching, reading
+    stops at the first row whose hash is not in the gold result, which is
+    enough to make the two digests differ.
+    """
+    digest = ResultDigest(normalize=normalize)
+    for row in iter_rows(cursor, deadline=deadline):
+        if digest.update(row) not in ground_truth_hashes:
+            break
+    return digest.hexdigest()
+
+
+def run_digests(
+    predicted_sql,
+    ground_truth,
+    db_path,
+    sql_dialect,
+    gold_cache_path=None,
+    deadline=None,
+    float_precision=None,
+    null_value=None,
+):
+    """Execute a pred/gold pair and return the digests of both result sets."""
+    normalize = make_normalizer(float_precision, null_value)
+    conn = get_connection(sql_dialect, db_path)
+    try:
+        cursor = conn.cursor()
+        ground_truth_digest, ground_truth_hashes = fetch_gold_digest(
+            conn,
+            cursor,
+            ground_truth,
+            db_path,
+            sql_dialect,
+            gold_cache_path,
+            deadline,
+            normalize,
+            normalizer_tag(float_precision, null_value),
+        )
+        cursor.close()
+        pred_cursor = open_stream_cursor(conn, sql_dialect)
+        try:
+            predicted_digest = run_query(
+                conn,
+                pred_cursor,
+                predicted_sql,
+                sql_dialect,
+                deadline,
+                fetch=lambda c: fetch_matching_digest(
+                    c, ground_truth_hashes, normalize, deadline
+                ),
+            )
+        finally:
+            close_stream_cursor(pred_cursor, sql_dialect, db_path)
+    finally:
+        release_connection(conn, sql_dialect, db_path)
+    return predicted_digest, ground_truth_digest
+
+
+# sqlite3 errors that depend on the state of the database file or the
+# process rather than on the SQL, so their outcome is never recorded
+SQLITE_TRANSIENT_ERRORS = (
+    "database is locked",
+    "database table is locked",
+    "disk i/o error",
+    "unable to open database",
+    "database disk image is malformed",
+    "interrupted",
+    "out of memory",
+)
+
+
+def is_deterministic_error(e):
+    """Whether a predicted query would fail with this error again on every run (bad SQL)."""
+    # errors replayed from the execution cache were deterministic when recorded,
+    # and the result caps are part of the score settings
+    if isinstance(e, (CachedExecutionError, ResultTooLarge)):
+        return True
+    if isinstance(e, (sqlite3.ProgrammingError, sqlite3.Warning)):
+        return True
+    if isinstance(e, sqlite3.OperationalError):
+        message = str(e).lower()
+        return not any(pattern in message for pattern in SQLITE_TRANSIENT_ERRORS)
+    # a write rejected by the read-only authorizer (the SQLite mode is part of the key)
+    return isinstance(e, sqlite3.DatabaseError) and str(e) == "not authorized"
+
+
+def fetch_digests(
+    predicted_sql,
+    ground_truth,
+    db_path,
+    sql_dialect,
+    gold_cache_path=None,
+    deadline=None,
+    float_precision=None,
+    null_value=None,
+    execution_cache_path=None,
+    time_budget=None,
+):
+    """
+    Return the digests of a pred/gold pair like run_digests. With an
+    execution cache, a predicted query (up to whitespace and comments) that
+    was already run against the same gold query and database is not executed
+    again: its digests are returned, its error is raised again as
+    CachedExecutionError (only errors caused by the SQL itself are recorded,
+    see is_deterministic_error), and its timeout is raised again if it happened
+    within a time budget at least as large as time_budget. Outcomes are kept
+    apart per SQLite mode, since read-only modes reject writes a file accepts.
+    """
+    options = "{};sqlite_mode={}".format(
+        normalizer_tag(float_precision, null_value), current_sqlite_mode()
+    )
+    db_fingerprint = None
+    if execution_cache_path:
+        db_fingerprint = database_fingerprint(sql_dialect, db_path)
+    if db_fingerprint is not None:
+        cached = load_execution(
+            execution_cache_path, predicted_sql, ground_truth, db_path, db_fingerprint, options
+        )
+        if cached is None:
+            pass
+        elif cached["outcome"] == "ok":
+            return cached["predicted_digest"], cached["ground_truth_digest"]
+        elif cached["outcome"] == "error":
+            raise CachedExecutionError(cached["error_class"])
+        elif time_budget is not None and cached["time_budget"] >= time_budget:
+            raise QueryTimeout("query already timed out within at least this time budget")
+    try:
+        predicted_digest, ground_truth_digest = run_digests(
+            predicted_sql,
+            ground_truth,
+            db_path,
+            sql_dialect,
+            gold_cache_path,
+            deadline,
+            float_precision,
+            null_value,
+        )
+    except QueryTimeout:
+        if db_fingerprint is not None and time_budget is not None:
+            store_execution(
+                execution_cache_path,
+                predicted_sql,
+                ground_truth,
+                db_path,
+                db_fingerprint,
+                options,
+                "timeout",
+                time_budget=time_budget,
+            )
+        raise
+    except Exception as e:
+        if db_fingerprint is not None and is_deterministic_error(e):
+            store_execution(
+                execution_cache_path,
+                predicted_sql,
+                ground_truth,
+                db_path,
+                db_fingerprint,
+                options,
+                "error",
+                error_class=type(e).__name__,
+            )
+        raise
+    if db_fingerprint is not None:
+        store_execution(
+            execution_cache_path,
+            predicted_sql,
+            ground_truth,
+            db_path,
+            db_fingerprint,
+            options,
+            "ok",
+            predicted_digest,
+            ground_truth_digest,
+        )
+    return predicted_digest, ground_truth_digest
+
+
+def execute_sql(
+    predicted_sql,
+    ground_truth,
+    db_path,
+    sql_dialect,
+    calculate_func,
+    gold_cache_path=None,
+    deadline=None,
+    match_gold=False,
+    row_cap_factor=ROW_CAP_FACTOR,
+    max_result_bytes=MAX_RESULT_BYTES,
+):
+    predicted_res, ground_truth_res = fetch_results(
+        predicted_sql,
+        ground_truth,
+        db_path,
+        sql_dialect,
+        gold_cache_path,
+        deadline,
+        match_gold,
+        row_cap_factor,
+        max_result_bytes,
+    )
     res = calculate_func(predicted_res, ground_truth_res)
     return res
 
 
+def clean_predicted_sql(sql_str):
+    """Split one prediction entry into its SQL and db_id, as package_sqls reads them."""
+    if isinstance(sql_str, str):
+        try:
+            sql, db_name = sql_str.split("\t----- bird -----\t")
+        except ValueError:
+            sql = sql_str.strip()
+            db_name = "financial"  # Default database when no db_name is provided
+    elif isinstance(sql_str, dict) and "sql" in sql_str:
+        # Handle case where predictions are saved as objects
+        sql = sql_str["sql"]
+        db_name = sql_str.get("db_id", "financial")
+    else:
+        # Default for empty or malformed entries
+        sql = " "
+        db_name = "financial"               
+
+    # Clean SQL strings that might have escaped quotes or encodings
+    sql = sql.strip()
+
+    # Handle empty results with a placeholder
+    if not sql or len(sql) < 2:
+        sql = "SELECT 'empty' AS result"
+    return sql, db_name
+
+
 def package_sqls(
     sql_path, db_root_path, mode="pred"
 ):
@@ -157,28 +926,7 @@ def package_sqls(
                 raise ValueError(f"Unexpected JSON format in {sql_path}")
                 
             for _, sql_str in sql_items:
-                if isinstance(sql_str, str):
-                    try:
-                        sql, db_name = sql_str.split("\t----- bird -----\t")
-                    except ValueError:
-                        sql = sql_str.strip()
-                        db_name = "financial"  # Default database when no db_name is provided
-                elif isinstance(sql_str, dict) and "sql" in sql_str:
-                    # Handle case where predictions are saved as objects
-                    sql = sql_str["sql"]
-                    db_name = sql_str.get("db_id", "financial")
-                else:
-                    # Default for empty or malformed entries
-                    sql = " "
-                    db_name = "financial"               
-                
-                # Clean SQL strings that might have escaped quotes or encodings
-                sql = sql.strip()
-                
-                # Handle empty results with a placeholder
-                if not sql or len(sql) < 2:
-                    sql = "SELECT 'empty' AS result"
-                
+                sql, db_name = clean_predicted_sql(sql_str)
                 clean_sqls.append(sql)
                 db_path_list.append(db_root_path + db_name + "/" + db_name + ".sqlite")
                 
@@ -207,6 +955,183 @@ def package_sqls(
     return clean_sqls, db_path_list
 
 
+def gold_query_cost(ground_truth, db_path, sql_dialect):
+    """
+    Rough cost of a gold query from its plan alone: the number of full table
+    scans in SQLite's EXPLAIN QUERY PLAN (plus one) times the database size.
+    Other dialects and unplannable queries get a cost of 1.
+    """
+    if sql_dialect != "SQLite" or not os.path.isfile(db_path):
+        return 1
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        plan = conn.execute(f"EXPLAIN QUERY PLAN {ground_truth}").fetchall()
+    except Exception:
+        return 1
+    finally:
+        conn.close()
+    scans = sum(1 for row in plan if str(row[-1]).startswith("SCAN"))
+    return (1 + scans) * os.path.getsize(db_path)
+
+
+def estimate_runtimes(ground_truths, db_places, sql_dialect, history=None):
+    """
+    Expected runtime of every question, for longest-expected-first scheduling.
+    Questions with a recorded latency in history ({sql_idx: seconds}, see
+    checkpoint.load_runtime_history) use it; the others fall back to
+    gold_query_cost, scaled to seconds by the median latency/cost ratio of
+    the questions that have both.
+    """
+    history = history or {}
+    costs = [
+        gold_query_cost(ground_truth, db_place, sql_dialect)
+        for ground_truth, db_place in zip(ground_truths, db_places)
+    ]
+    ratios = sorted(
+        history[i] / costs[i] for i in range(len(costs)) if i in history and costs[i] > 0
+    )
+    scale = ratios[len(ratios) // 2] if ratios else 1
+    return [history[i] if i in history else costs[i] * scale for i in range(len(costs))]
+
+
+def schedule_batches(
+    db_places,
+    num_cpus=1,
+    schedule="question",
+    skip_indices=(),
+    estimates=None,
+    sqlite_mode="file",
+    sql_dialect="SQLite",
+):
+    """
+    Group task indices into the batches run_sqls_parallel submits to its pool,
+    leaving out skip_indices (pairs a resumed run has already finished).
+
+    "question" submits every pair on its own, in question order. "db" groups
+    the pairs by database (the db_id package_sqls folds into each path) so a
+    worker runs a whole group back to back and keeps that database warm in
+    its connection pool and page cache. Groups larger than an even share of
+    the work are split, so a dominant database is spread over a few workers
+    instead of one, and the batches are submitted largest first to keep the
+    pool balanced. "longest" submits every pair on its own, longest expected
+    runtime first (see estimate_runtimes), so slow queries do not start last
+    and leave the other workers idle while they finish. With estimates, "db"
+    batches are ordered by their expected runtime too.
+
+    With sqlite_mode "memory" SQLite pairs are always grouped by database:
+    every database a worker moves on to is copied into memory again once it
+    has been evicted (see MAX_SNAPSHOT_BYTES), so walking the databases in
+    question order would copy them over and over.
+    """
+    if sql_dialect == "SQLite" and sqlite_mode == "memory" and schedule != "db":
+        print(f"Scheduling by database instead of by {schedule} for in-memory snapshots")
+        schedule = "db"
+    pending = [i for i in range(len(db_places)) if i not in skip_indices]
+    if schedule == "question":
+        return [[i] for i in pending]
+    if schedule == "longest":
+        if estimates is None:
+            raise ValueError("The longest schedule needs runtime estimates")
+        return [[i] for i in sorted(pending, key=lambda i: estimates[i], reverse=True)]
+    if schedule != "db":
+        raise ValueError(f"Unsupported schedule: {schedule}")
+    groups = {}
+    for i in pending:
+        groups.setdefault(db_places[i], []).append(i)
+    share = max(1, math.ceil(len(pending) / max(num_cpus, 1)))
+    batches = []
+    for indices in groups.values():
+        for start in range(0, len(indices), share):
+            batches.append(indices[start : start + share])
+    if estimates is not None:
+        batches.sort(key=lambda batch: sum(estimates[i] for i in batch), reverse=True)
+    else:
+        batches.sort(key=len, reverse=True)
+    return batches
+
+
+def execute_batch(func, batch_args):
+    """Run func over a batch of argument tuples inside one pool worker."""
+    return [func(*args) for args in batch_args]
+
+
+def run_pairs_parallel(
+    execute_model,
+    task_args,
+    db_places,
+    num_cpus=1,
+    schedule="question",
+    sqlite_mode="file",
+    skip_indices=(),
+    estimates=None,
+    callback=None,
+    sql_dialect="SQLite",
+    max_snapshot_bytes=MAX_SNAPSHOT_BYTES,
+):
+    """
+    Run execute_model(*task_args(i)) for every pair i not in skip_indices on a
+    pool of num_cpus workers, in the batches of schedule_batches. Returns the
+    results in the order they finish; callback, if given, is called with each
+    result as soon as it arrives.
+    """
+    results = []
+
+    def batch_callback(batch_results):
+        for result in batch_results:
+            results.append(result)
+            if callback is not None:
+                callback(result)
+
+    pool = mp.Pool(
+        processes=num_cpus,
+        initializer=init_worker,
+        initargs=(sqlite_mode, max_snapshot_bytes),
+    )
+    for batch in schedule_batches(
+        db_places, num_cpus, schedule, skip_indices, estimates, sqlite_mode, sql_dialect
+    ):
+        pool.apply_async(
+            execute_batch,
+            args=(execute_model, [task_args(i) for i in batch]),
+            callback=batch_callback,
+        )
+    pool.close()
+    pool.join()
+    return results
+
+
+# Command-line arguments that can change the score of a pair. Checkpoints and
+# the results store only reuse results produced under the same values.
+SCORE_SETTINGS = (
+    "sql_dialect",
+    "meta_time_out",
+    "sqlite_mode",
+    "ex_compare",
+    "float_precision",
+    "null_value",
+    "row_cap_factor",
+    "max_result_mb",
+    "f1_engine",
+    "f1_pairing",
+    "iterate_num",
+    "ves_metric",
+    "ves_sampling",
+    "warmup_num",
+    "min_iterations",
+    "gold_profile_path",
+    "gold_profile_max_age",
+)
+
+
+def score_settings(metric, args):
+    """Everything besides the inputs that decides a score: the metric and every SCORE_SETTINGS argument the evaluator has."""
+    settings = {"metric": metric}
+    for name in SCORE_SETTINGS:
+        if hasattr(args, name):
+            settings[name] = getattr(args, name)
+    return settings
+
+
 def sort_results(list_of_dicts):
     return sorted(list_of_dicts, key=lambda x: x["sql_idx"])
 
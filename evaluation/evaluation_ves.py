@@ -2,24 +2,33 @@ import sys
 import json
 import numpy as np
 import argparse
-import multiprocessing as mp
-from func_timeout import func_timeout, FunctionTimedOut
 from evaluation_utils import (
     load_jsonl,
-    execute_sql,
     package_sqls,
     sort_results,
     print_data,
-    connect_db,
+    get_connection,
+    release_connection,
+    run_query,
+    fetch_results,
+    QueryTimeout,
+    is_deterministic_error,
+    current_sqlite_mode,
+    SQLITE_MODES,
+    MAX_SNAPSHOT_BYTES,
+    run_pairs_parallel,
 )
+from checkpoint import ResumableRun, schedule_estimates
+from result_cache import (
+    database_fingerprint,
+    load_gold_timings,
+    store_gold_timings,
+)
+import re
 import time
 import math
 
 
-def result_callback(result):
-    exec_result.append(result)
-
-
 def clean_abnormal(input):
     input = np.asarray(input)
     processed_list = []
@@ -31,40 +40,233 @@ def clean_abnormal(input):
     return processed_list
 
 
-def execute_sql(sql, db_path, sql_dialect, return_time=False):
-    # Connect to the database
-    conn = connect_db(sql_dialect, db_path)
-    start_time = time.time()
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    res = cursor.fetchall()
-    conn.close()  # Don't forget to close the connection!
-    exec_time = time.time() - start_time
-    if return_time:
-        return exec_time
+# Untimed pred/gold runs before measuring, to settle caches and query plans
+WARMUP_NUM = 1
+# Adaptive sampling: fewest timed iterations before the stopping rule applies
+MIN_ITERATIONS = 5
+# Adaptive sampling: z-score of the confidence interval around the mean ratio
+CONFIDENCE_Z = 1.96
+# SQLite VM instructions per progress-handler call when counting VM steps
+VM_STEP_GRANULARITY = 1000
+# Queries taking at most this many VM steps are counted again one step at a
+# time; above it the coarse count is off by less than 1%
+EXACT_VM_STEPS = 100000
+# Top-level "(actual time=first..last ...)" of MySQL's EXPLAIN ANALYZE tree, in ms
+MYSQL_ACTUAL_TIME = re.compile(r"actual time=[\d.]+\.\.([\d.]+)")
 
-    return res
 
+def time_sql(conn, cursor, sql, sql_dialect, deadline=None):
+    """Run sql once on a prepared connection and return its execute + fetch time in ns."""
+    _, exec_time = run_query(conn, cursor, sql, sql_dialect, deadline, return_time=True)
+    return exec_time
 
-def iterated_execute_sql(
-    predicted_sql, ground_truth, db_path, iterate_num, sql_dialect
+
+def server_time_sql(conn, cursor, sql, sql_dialect, deadline=None):
+    """
+    Run sql once under EXPLAIN ANALYZE and return the execution time the
+    server reports, in ns. The result rows never leave the server, so network
+    transfer and driver row decoding stay out of the measurement.
+    """
+    if sql_dialect == "PostgreSQL":
+        # TIMING OFF skips per-node clock reads; the total is still measured
+        rows = run_query(
+            conn, cursor, f"EXPLAIN (ANALYZE, TIMING OFF, FORMAT JSON) {sql}", sql_dialect, deadline
+        )
+        plan = rows[0][0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        exec_ms = plan[0]["Planning Time"] + plan[0]["Execution Time"]
+    elif sql_dialect == "MySQL":
+        rows = run_query(conn, cursor, f"EXPLAIN ANALYZE {sql}", sql_dialect, deadline)
+        match = MYSQL_ACTUAL_TIME.search(rows[0][0])
+        if match is None:
+            raise ValueError("EXPLAIN ANALYZE output has no actual time")
+        exec_ms = float(match.group(1))
+    else:
+        raise ValueError(f"server-side timing is not available for {sql_dialect}")
+    return int(exec_ms * 1e6)
+
+
+def profile_timer(timer, sql_dialect, warmup_num, iterate_num):
+    """
+    Key gold profiles by everything about how they were timed besides the
+    host: the timer, the number of warmup and timed runs and, for SQLite, how
+    the worker opens databases (an in-memory snapshot is far faster than a file).
+    """
+    tag = f"{timer}|warmup={warmup_num}|iterations={iterate_num}"
+    if sql_dialect == "SQLite":
+        tag += f"|sqlite_mode={current_sqlite_mode()}"
+    return tag
+
+
+def measure_time_ratio(
+    predicted_sql,
+    ground_truth,
+    db_path,
+    iterate_num,
+    sql_dialect,
+    deadline=None,
+    warmup_num=WARMUP_NUM,
+    sampling="fixed",
+    min_iterations=MIN_ITERATIONS,
+    timer="client",
+    gold_profile_path=None,
+    gold_profile_max_age=None,
 ):
-    diff_list = []
-    predicted_res = execute_sql(predicted_sql, db_path, sql_dialect)
-    ground_truth_res = execute_sql(ground_truth, db_path, sql_dialect)
-    reward = 0
-    time_ratio = 0
-    if set(predicted_res) == set(ground_truth_res):
-        for _ in range(iterate_num):
-            predicted_time = execute_sql(
-                predicted_sql, db_path, sql_dialect, return_time=True
-            )
-            ground_truth_time = execute_sql(
-                ground_truth, db_path, sql_dialect, return_time=True
-            )
-            diff_list.append(ground_truth_time / predicted_time)
-        processed_diff_list = clean_abnormal(diff_list)
-        time_ratio = sum(processed_diff_list) / len(processed_diff_list)
+    """
+    Average gold/pred execution time ratio over iterate_num runs of each query.
+
+    Both queries run on the same pooled connection and cursor, so connection
+    setup never lands in the timed region, and are timed with perf_counter_ns.
+    warmup_num untimed runs come first, and the order of the pair alternates
+    every iteration so neither query systematically runs on caches the other
+    just warmed.
+
+    With sampling="adaptive" iterate_num is only a ceiling: timing stops as
+    soon as the confidence interval of the mean ratio (after min_iterations)
+    lies inside a single compute_reward bucket, since more samples could not
+    change the reward.
+
+    timer="server" takes the times reported by EXPLAIN ANALYZE on MySQL and
+    PostgreSQL instead of timing execute + fetch on the client.
+
+    With a gold_profile_path the gold latencies measured here are stored as a
+    profile for this host, timer, warmup, iterate_num and SQLite mode, and
+    later runs (of any model) with the same setup only time the predicted
+    query against the cleaned mean of that profile. Only complete profiles
+    are stored: an adaptive run that stopped early leaves none behind.
+    Profiles older than gold_profile_max_age seconds are measured again.
+    """
+    time_sql_func = server_time_sql if timer == "server" else time_sql
+    db_fingerprint = None
+    ground_truth_profile = None
+    if gold_profile_path:
+        db_fingerprint = database_fingerprint(sql_dialect, db_path)
+    if db_fingerprint is not None:
+        ground_truth_profile = load_gold_timings(
+            gold_profile_path,
+            ground_truth,
+            db_path,
+            db_fingerprint,
+            profile_timer(timer, sql_dialect, warmup_num, iterate_num),
+            gold_profile_max_age,
+        )
+    conn = get_connection(sql_dialect, db_path)
+    try:
+        cursor = conn.cursor()
+        if ground_truth_profile is not None:
+            processed_ground_truth = clean_abnormal(ground_truth_profile)
+            ground_truth_time = sum(processed_ground_truth) / len(processed_ground_truth)
+            for _ in range(warmup_num):
+                time_sql_func(conn, cursor, predicted_sql, sql_dialect, deadline)
+        else:
+            for _ in range(warmup_num):
+                time_sql_func(conn, cursor, predicted_sql, sql_dialect, deadline)
+                time_sql_func(conn, cursor, ground_truth, sql_dialect, deadline)
+        diff_list = []
+        ground_truth_samples = []
+        for i in range(iterate_num):
+            if ground_truth_profile is not None:
+                predicted_time = time_sql_func(conn, cursor, predicted_sql, sql_dialect, deadline)
+            elif i % 2 == 0:
+                predicted_time = time_sql_func(conn, cursor, predicted_sql, sql_dialect, deadline)
+                ground_truth_time = time_sql_func(conn, cursor, ground_truth, sql_dialect, deadline)
+                ground_truth_samples.append(ground_truth_time)
+            else:
+                ground_truth_time = time_sql_func(conn, cursor, ground_truth, sql_dialect, deadline)
+                predicted_time = time_sql_func(conn, cursor, predicted_sql, sql_dialect, deadline)
+                ground_truth_samples.append(ground_truth_time)
+            diff_list.append(ground_truth_time / max(predicted_time, 1))
+            if sampling == "adaptive" and reward_settled(diff_list, min_iterations):
+                break
+        cursor.close()
+    finally:
+        release_connection(conn, sql_dialect, db_path)
+    if db_fingerprint is not None and ground_truth_samples and len(ground_truth_samples) == iterate_num:
+        store_gold_timings(
+            gold_profile_path,
+            ground_truth,
+            db_path,
+            db_fingerprint,
+            profile_timer(timer, sql_dialect, warmup_num, iterate_num),
+            ground_truth_samples,
+        )
+    processed_diff_list = clean_abnormal(diff_list)
+    time_ratio = sum(processed_diff_list) / len(processed_diff_list)
+    return time_ratio
+
+
+def count_vm_steps(conn, cursor, sql, deadline=None, granularity=VM_STEP_GRANULARITY):
+    """
+    Execute sql once on a SQLite connection and return how many virtual-machine
+    instructions it took, counted through the progress handler in units of
+    granularity (rounded up, so the count is never zero). With granularity 1
+    the handler runs on every instruction and the count is exact.
+    """
+    calls = 0
+
+    def handler():
+        nonlocal calls
+        calls += 1
+        if deadline is not None and time.perf_counter() >= deadline:
+            return 1
+        return 0
+
+    conn.set_progress_handler(handler, granularity)
+    try:
+        cursor.execute(sql)
+        cursor.fetchall()
+    except Exception as e:
+        if deadline is not None and time.perf_counter() >= deadline:
+            raise QueryTimeout("query was interrupted at its deadline") from e
+        raise
+    finally:
+        conn.set_progress_handler(None, granularity)
+    if granularity == 1:
+        return max(calls, 1)
+    return (calls + 1) * granularity
+
+
+def vm_steps(conn, cursor, sql, deadline=None):
+    """
+    VM steps of sql: counted coarsely first, which costs one Python call per
+    VM_STEP_GRANULARITY instructions, and exactly for queries small enough
+    (most of BIRD) that the rounding would flatten their differences.
+    """
+    steps = count_vm_steps(conn, cursor, sql, deadline)
+    if steps <= EXACT_VM_STEPS:
+        steps = count_vm_steps(conn, cursor, sql, deadline, granularity=1)
+    return steps
+
+
+def measure_vm_step_ratio(predicted_sql, ground_truth, db_path, deadline=None):
+    """
+    Gold/pred ratio of SQLite VM steps. Unlike wall-clock time the step count
+    is deterministic, so one execution per query gives a ratio that is
+    reproducible across machines and load levels.
+    """
+    conn = get_connection("SQLite", db_path)
+    try:
+        cursor = conn.cursor()
+        predicted_steps = vm_steps(conn, cursor, predicted_sql, deadline)
+        ground_truth_steps = vm_steps(conn, cursor, ground_truth, deadline)
+        cursor.close()
+    finally:
+        release_connection(conn, "SQLite", db_path)
+    return ground_truth_steps / predicted_steps
+
+
+def reward_settled(diff_list, min_iterations=MIN_ITERATIONS, z=CONFIDENCE_Z):
+    """Whether the confidence interval of the mean time ratio falls in one reward bucket."""
+    if len(diff_list) < max(min_iterations, 2):
+        return False
+    samples = np.asarray(diff_list)
+    mean = np.mean(samples)
+    half_width = z * np.std(samples, ddof=1) / math.sqrt(len(samples))
+    return compute_reward(mean - half_width) == compute_reward(mean + half_width)
+
+
+def compute_reward(time_ratio):
     if time_ratio == 0:
         reward = 0
     elif time_ratio >= 2:
@@ -77,31 +279,109 @@ def iterated_execute_sql(
         reward = 0.5
     else:
         reward = 0.25
+    return reward
+
+
+def iterated_execute_sql(
+    predicted_sql,
+    ground_truth,
+    db_path,
+    iterate_num,
+    sql_dialect,
+    deadline=None,
+    warmup_num=WARMUP_NUM,
+    sampling="fixed",
+    min_iterations=MIN_ITERATIONS,
+    ves_metric="time",
+    gold_profile_path=None,
+    gold_profile_max_age=None,
+):
+    # only the rows needed to settle EX are read, see fetch_matching
+    predicted_res, ground_truth_res = fetch_results(
+        predicted_sql, ground_truth, db_path, sql_dialect, deadline=deadline, match_gold=True
+    )
+    time_ratio = 0
+    if set(predicted_res) != set(ground_truth_res):
+        pass
+    elif ves_metric == "vm_steps":
+        time_ratio = measure_vm_step_ratio(predicted_sql, ground_truth, db_path, deadline)
+    else:
+        time_ratio = measure_time_ratio(
+            predicted_sql,
+            ground_truth,
+            db_path,
+            iterate_num,
+            sql_dialect,
+            deadline,
+            warmup_num,
+            sampling,
+            min_iterations,
+            timer="server" if ves_metric == "server_time" else "client",
+            gold_profile_path=gold_profile_path,
+            gold_profile_max_age=gold_profile_max_age,
+        )
+    reward = compute_reward(time_ratio)
     # return time_ratio
     return reward
 
 
 def execute_model(
-    predicted_sql, ground_truth, db_place, idx, iterate_num, meta_time_out, sql_dialect
+    predicted_sql,
+    ground_truth,
+    db_place,
+    idx,
+    iterate_num,
+    meta_time_out,
+    sql_dialect,
+    warmup_num=WARMUP_NUM,
+    sampling="fixed",
+    min_iterations=MIN_ITERATIONS,
+    ves_metric="time",
+    gold_profile_path=None,
+    gold_profile_max_age=None,
 ):
+    # you can personalize the total timeout number
+    # larger timeout leads to more stable ves
+    # while it needs more your patience....
+    start_time = time.perf_counter()
+    error = None
+    # timeouts and errors of the database rather than the SQL (not kept in the results store)
+    transient_error = False
+    deadline = start_time + meta_time_out * iterate_num
     try:
-        # you can personalize the total timeout number
-        # larger timeout leads to more stable ves
-        # while it needs more your patience....
-        reward = func_timeout(
-            meta_time_out * iterate_num,
-            iterated_execute_sql,
-            args=(predicted_sql, ground_truth, db_place, iterate_num, sql_dialect),
+        reward = iterated_execute_sql(
+            predicted_sql,
+            ground_truth,
+            db_place,
+            iterate_num,
+            sql_dialect,
+            deadline,
+            warmup_num,
+            sampling,
+            min_iterations,
+            ves_metric,
+            gold_profile_path,
+            gold_profile_max_age,
         )
     except KeyboardInterrupt:
         sys.exit(0)
-    except FunctionTimedOut:
+    except QueryTimeout:
+        transient_error = True
         result = [(f"timeout",)]
+        error = "QueryTimeout"
         reward = 0
     except Exception as e:
+        transient_error = not is_deterministic_error(e)
         result = [(f"error",)]  # possibly len(query) > 512 or not executable
+        error = type(e).__name__
         reward = 0
-    result = {"sql_idx": idx, "reward": reward}
+    result = {
+        "sql_idx": idx,
+        "reward": reward,
+        "time": time.perf_counter() - start_time,
+        "error": error,
+        "transient_error": transient_error,
+    }
     return result
 
 
@@ -112,25 +392,50 @@ def run_sqls_parallel(
     iterate_num=100,
     meta_time_out=30.0,
     sql_dialect="SQLite",
+    schedule="question",
+    warmup_num=WARMUP_NUM,
+    sampling="fixed",
+    min_iterations=MIN_ITERATIONS,
+    ves_metric="time",
+    gold_profile_path=None,
+    gold_profile_max_age=None,
+    sqlite_mode="file",
+    skip_indices=(),
+    estimates=None,
+    callback=None,
+    max_snapshot_bytes=MAX_SNAPSHOT_BYTES,
 ):
-    pool = mp.Pool(processes=num_cpus)
-    for i, sql_pair in enumerate(sqls):
-        predicted_sql, ground_truth = sql_pair
-        pool.apply_async(
-            execute_model,
-            args=(
-                predicted_sql,
-                ground_truth,
-                db_places[i],
-                i,
-                iterate_num,
-                meta_time_out,
-                sql_dialect,
-            ),
-            callback=result_callback,
+    def task_args(i):
+        predicted_sql, ground_truth = sqls[i]
+        return (
+            predicted_sql,
+            ground_truth,
+            db_places[i],
+            i,
+            iterate_num,
+            meta_time_out,
+            sql_dialect,
+            warmup_num,
+            sampling,
+            min_iterations,
+            ves_metric,
+            gold_profile_path,
+            gold_profile_max_age,
         )
-    pool.close()
-    pool.join()
+
+    return run_pairs_parallel(
+        execute_model,
+        task_args,
+        db_places,
+        num_cpus,
+        schedule,
+        sqlite_mode,
+        skip_indices,
+        estimates,
+        callback,
+        sql_dialect,
+        max_snapshot_bytes,
+    )
 
 
 def compute_ves(exec_results):
@@ -239,8 +544,49 @@ if __name__ == "__main__":
     args_parser.add_argument("--diff_json_path", type=str, default="")
     args_parser.add_argument("--sql_dialect", type=str, default="SQLite")
     args_parser.add_argument("--output_log_path", type=str, default="SQLite")
+    # "db" groups pairs by database so each worker keeps its databases warm,
+    # "longest" starts the pairs expected to run longest first
+    args_parser.add_argument(
+        "--schedule", type=str, default="question", choices=["question", "db", "longest"]
+    )
+    # checkpoint of an earlier run whose per-query latencies guide the "longest" schedule
+    args_parser.add_argument("--runtime_history_path", type=str, default="")
+    args_parser.add_argument("--iterate_num", type=int, default=100)
+    # untimed pred/gold runs before the timed iterations
+    args_parser.add_argument("--warmup_num", type=int, default=WARMUP_NUM)
+    # "adaptive" stops timing once the reward bucket is settled; iterate_num becomes the ceiling
+    args_parser.add_argument(
+        "--ves_sampling", type=str, default="fixed", choices=["fixed", "adaptive"]
+    )
+    args_parser.add_argument("--min_iterations", type=int, default=MIN_ITERATIONS)
+    # "vm_steps" rewards the SQLite VM-step ratio of a single run instead of timing,
+    # "server_time" times MySQL/PostgreSQL queries with EXPLAIN ANALYZE on the server
+    args_parser.add_argument(
+        "--ves_metric", type=str, default="time", choices=["time", "vm_steps", "server_time"]
+    )
+    # SQLite file keeping gold timing profiles across runs and models (SQLite dialect only)
+    args_parser.add_argument("--gold_profile_path", type=str, default="")
+    # re-measure gold timing profiles older than this many seconds; 0 keeps them forever
+    args_parser.add_argument("--gold_profile_max_age", type=float, default=0)
+    # "readonly" opens SQLite files immutable with mmap and rejects writes,
+    # "memory" runs every query against a per-worker in-memory copy of the database
+    # (pairs are then always scheduled by database, see schedule_batches)
+    args_parser.add_argument(
+        "--sqlite_mode", type=str, default="file", choices=list(SQLITE_MODES)
+    )
+    # most MB of databases a worker keeps as in-memory snapshots with --sqlite_mode memory
+    args_parser.add_argument(
+        "--max_snapshot_mb", type=int, default=MAX_SNAPSHOT_BYTES // (1024 * 1024)
+    )
+    # JSONL file every result is appended to; rerunning with it resumes the run
+    args_parser.add_argument("--checkpoint_path", type=str, default="")
+    # results store (SQLite); pairs unchanged since they were stored are not executed again
+    args_parser.add_argument("--results_store_path", type=str, default="")
     args = args_parser.parse_args()
-    exec_result = []
+    if args.ves_metric == "vm_steps" and args.sql_dialect != "SQLite":
+        args_parser.error("--ves_metric vm_steps is only available for SQLite")
+    if args.ves_metric == "server_time" and args.sql_dialect == "SQLite":
+        args_parser.error("--ves_metric server_time is only available for MySQL and PostgreSQL")
 
     pred_queries, db_paths = package_sqls(
         args.predicted_sql_path,
@@ -254,14 +600,31 @@ if __name__ == "__main__":
         mode="gt",
     )
     query_pairs = list(zip(pred_queries, gt_queries))
+
+    run = ResumableRun("ves", args, query_pairs, db_paths_gt)
+    estimates = schedule_estimates(args, gt_queries, db_paths_gt)
+
     run_sqls_parallel(
         query_pairs,
         db_places=db_paths_gt,
         num_cpus=args.num_cpus,
+        iterate_num=args.iterate_num,
         meta_time_out=args.meta_time_out,
         sql_dialect=args.sql_dialect,
+        schedule=args.schedule,
+        warmup_num=args.warmup_num,
+        sampling=args.ves_sampling,
+        min_iterations=args.min_iterations,
+        ves_metric=args.ves_metric,
+        gold_profile_path=args.gold_profile_path,
+        gold_profile_max_age=args.gold_profile_max_age,
+        sqlite_mode=args.sqlite_mode,
+        skip_indices=run.skip_indices,
+        estimates=estimates,
+        callback=run.add,
+        max_snapshot_bytes=args.max_snapshot_mb * 1024 * 1024,
     )
-    exec_result = sort_results(exec_result)
+    exec_result = run.finish()
     # print_reward_category(exec_result, args.engine, args.sql_dialect)
     print("start calculate R-VES")
     simple_ves, moderate_ves, challenging_ves, ves, count_lists = compute_ves_by_diff(
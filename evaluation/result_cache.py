@@ -0,0 +1,427 @@
+"""
+On-disk cache of gold query results.
+
+The cache is a single SQLite file: every entry is keyed by a hash of the gold
+SQL text, the database name and a fingerprint of the database file, and holds
+either the result rows as JSON (see encode_rows) or the result's digest and packed row hashes
+(see result_digest.py). SQLite gives us a compact single-file format that
+many evaluation workers can read concurrently (WAL mode) through memory-mapped
+I/O. When a database file changes its fingerprint changes too, so stale
+entries are never returned and are pruned the next time that database is
+cached again.
+
+Gold timing profiles for R-VES live in the same kind of file, additionally
+keyed by the host they were measured on and the timer that measured them
+(which also records the warmup and SQLite mode), since latencies do not
+carry over between machines or setups.
+
+The same file can also serve as a results store for incremental evaluation:
+scored_pairs maps a hash of everything that determines a score (question
+index, predicted SQL, gold SQL, database and metric settings) to the
+execute_model result, so unchanged predictions are not executed again.
+
+Finally, executions records the outcome of running a predicted query against
+a gold query (both digests, or the timeout or SQL error it ended with) keyed
+by the normalized predicted SQL (whitespace and comments collapsed) and the
+SQLite mode, so identical queries produced by different models are executed
+only once.
+"""
+import hashlib
+import json
+import os
+import platform
+import re
+import sqlite3
+import time
+
+# Bytes of the cache file each reader maps into memory
+CACHE_MMAP_SIZE = 1 << 30
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS gold_results (
+    sql_hash TEXT NOT NULL,
+    db_name TEXT NOT NULL,
+    db_fingerprint TEXT NOT NULL,
+    rows BLOB NOT NULL,
+    PRIMARY KEY (sql_hash, db_name, db_fingerprint)
+);
+CREATE TABLE IF NOT EXISTS gold_digests (
+    sql_hash TEXT NOT NULL,
+    db_name TEXT NOT NULL,
+    db_fingerprint TEXT NOT NULL,
+    options TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    row_hashes BLOB NOT NULL,
+    PRIMARY KEY (sql_hash, db_name, db_fingerprint, options)
+);
+CREATE TABLE IF NOT EXISTS gold_timings (
+    sql_hash TEXT NOT NULL,
+    db_name TEXT NOT NULL,
+    db_fingerprint TEXT NOT NULL,
+    host TEXT NOT NULL,
+    timer TEXT NOT NULL,
+    measured_at REAL NOT NULL,
+    samples TEXT NOT NULL,
+    PRIMARY KEY (sql_hash, db_name, db_fingerprint, host, timer)
+);
+CREATE TABLE IF NOT EXISTS executions (
+    sql_hash TEXT NOT NULL,
+    gold_hash TEXT NOT NULL,
+    db_name TEXT NOT NULL,
+    db_fingerprint TEXT NOT NULL,
+    options TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    predicted_digest TEXT,
+    ground_truth_digest TEXT,
+    time_budget REAL,
+    error_class TEXT,
+    PRIMARY KEY (sql_hash, gold_hash, db_name, db_fingerprint, options)
+);
+CREATE TABLE IF NOT EXISTS scored_pairs (
+    pair_hash TEXT PRIMARY KEY,
+    result TEXT NOT NULL
+);
+"""
+
+# String literals, quoted identifiers, comments, whitespace runs and everything else
+SQL_TOKENS = re.compile(
+    r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|--[^\n]*|/\*.*?\*/|\s+"""
+    r"""|(?:[^\s'"`\-/]|-(?!-)|/(?!\*))+|.""",
+    re.DOTALL,
+)
+
+# Cache connections opened by this process, keyed by cache path
+_cache_connections = {}
+# (cache_path, table, db_name, fingerprint) combinations already pruned by this process
+_pruned = set()
+
+
+def database_fingerprint(sql_dialect, db_path):
+    """
+    Fingerprint a SQLite database file from its size, modification time and
+    100-byte header (which carries SQLite's file change counter).
+
+    MySQL and PostgreSQL databases live on a server and have no file to
+    fingerprint, so None is returned and callers skip caching.
+    """
+    if sql_dialect != "SQLite" or not os.path.isfile(db_path):
+        return None
+    stat = os.stat(db_path)
+    with open(db_path, "rb") as db_file:
+        header = db_file.read(100)
+    return "{}-{}-{}".format(
+        stat.st_size, stat.st_mtime_ns, hashlib.sha1(header).hexdigest()
+    )
+
+
+def database_name(db_path):
+    return os.path.basename(db_path).split(".sqlite")[0]
+
+
+def host_signature():
+    """Identify the machine timings were taken on; profiles never move between hosts."""
+    return "{}|{}|{}|{}".format(
+        platform.node(), platform.machine(), platform.processor(), os.cpu_count()
+    )
+
+
+def sql_hash(sql):
+    return hashlib.sha256(sql.strip().encode("utf-8")).hexdigest()
+
+
+def normalize_sql(sql):
+    """Collapse comments and whitespace outside quoted strings and drop trailing semicolons."""
+    tokens = []
+    for token in SQL_TOKENS.findall(sql):
+        if token.isspace() or token.startswith(("--", "/*")):
+            # a comment separates tokens like whitespace does
+            if tokens and tokens[-1] == " ":
+                continue
+            token = " "
+        tokens.append(token)
+    return "".join(tokens).strip().rstrip(";").strip()
+
+
+def open_cache(cache_path):
+    conn = _cache_connections.get(cache_path)
+    if conn is None:
+        directory_path = os.path.dirname(cache_path)
+        if directory_path and not os.path.exists(directory_path):
+            os.makedirs(directory_path, exist_ok=True)
+        conn = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA mmap_size={CACHE_MMAP_SIZE}")
+        conn.executescript(CACHE_SCHEMA)
+        conn.commit()
+        _cache_connections[cache_path] = conn
+    return conn
+
+
+def encode_bytes(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"bytes": bytes(value).hex()}
+    raise TypeError(f"cannot cache a {type(value).__name__} value")
+
+
+def decode_bytes(value):
+    return bytes.fromhex(value["bytes"])
+
+
+def encode_rows(rows):
+    """
+    Serialize result rows as JSON text, BLOBs as {"bytes": hex}. Unlike a
+    pickle, loading an entry can never run code, so a cache file can be
+    shared safely. SQLite values (NULL, integers, reals including NaN and
+    infinities, text and BLOBs) round-trip exactly; anything else raises
+    TypeError.
+    """
+    return json.dumps([list(row) for row in rows], default=encode_bytes)
+
+
+def decode_rows(text):
+    return [tuple(row) for row in json.loads(text, object_hook=decode_bytes)]
+
+
+def load_gold_result(cache_path, ground_truth, db_path, db_fingerprint):
+    """Return the cached rows of a gold query, or None on a cache miss."""
+    conn = open_cache(cache_path)
+    row = conn.execute(
+        "SELECT rows FROM gold_results "
+        "WHERE sql_hash = ? AND db_name = ? AND db_fingerprint = ?",
+        (sql_hash(ground_truth), database_name(db_path), db_fingerprint),
+    ).fetchone()
+    if row is None:
+        return None
+    try:
+        return decode_rows(row[0])
+    except (TypeError, ValueError, KeyError):
+        # written in an older format; it is replaced once the query runs again
+        return None
+
+
+def prune_stale_entries(conn, cache_path, table, db_name, db_fingerprint):
+    """Delete entries for older versions of a database; they can never hit again."""
+    if (cache_path, table, db_name, db_fingerprint) in _pruned:
+        return
+    conn.execute(
+        f"DELETE FROM {table} WHERE db_name = ? AND db_fingerprint != ?",
+        (db_name, db_fingerprint),
+    )
+    _pruned.add((cache_path, table, db_name, db_fingerprint))
+
+
+def store_gold_result(cache_path, ground_truth, db_path, db_fingerprint, rows):
+    try:
+        encoded = encode_rows(rows)
+    except TypeError:
+        return
+    conn = open_cache(cache_path)
+    db_name = database_name(db_path)
+    with conn:
+        prune_stale_entries(conn, cache_path, "gold_results", db_name, db_fingerprint)
+        conn.execute(
+            "INSERT OR REPLACE INTO gold_results VALUES (?, ?, ?, ?)",
+            (
+                sql_hash(ground_truth),
+                db_name,
+                db_fingerprint,
+                encoded,
+            ),
+        )
+
+
+def load_gold_digest(cache_path, ground_truth, db_path, db_fingerprint, options):
+    """Return the cached (digest, packed row hashes) of a gold query, or None."""
+    conn = open_cache(cache_path)
+    row = conn.execute(
+        "SELECT digest, row_hashes FROM gold_digests WHERE sql_hash = ? "
+        "AND db_name = ? AND db_fingerprint = ? AND options = ?",
+        (sql_hash(ground_truth), database_name(db_path), db_fingerprint, options),
+    ).fetchone()
+    if row is None:
+        return None
+    return row[0], row[1]
+
+
+def store_gold_digest(
+    cache_path, ground_truth, db_path, db_fingerprint, options, digest, row_hashes
+):
+    conn = open_cache(cache_path)
+    db_name = database_name(db_path)
+    with conn:
+        prune_stale_entries(conn, cache_path, "gold_digests", db_name, db_fingerprint)
+        conn.execute(
+            "INSERT OR REPLACE INTO gold_digests VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                sql_hash(ground_truth),
+                db_name,
+                db_fingerprint,
+                options,
+                digest,
+                row_hashes,
+            ),
+        )
+
+
+def load_gold_timings(cache_path, ground_truth, db_path, db_fingerprint, timer, max_age=None):
+    """
+    Return the gold latency samples (in ns) recorded on this host, or None on a
+    miss. Profiles older than max_age seconds count as a miss so they get
+    measured again.
+    """
+    conn = open_cache(cache_path)
+    row = conn.execute(
+        "SELECT measured_at, samples FROM gold_timings WHERE sql_hash = ? "
+        "AND db_name = ? AND db_fingerprint = ? AND host = ? AND timer = ?",
+        (
+            sql_hash(ground_truth),
+            database_name(db_path),
+            db_fingerprint,
+            host_signature(),
+            timer,
+        ),
+    ).fetchone()
+    if row is None:
+        return None
+    if max_age and time.time() - row[0] > max_age:
+        return None
+    return json.loads(row[1])
+
+
+def store_gold_timings(cache_path, ground_truth, db_path, db_fingerprint, timer, samples):
+    conn = open_cache(cache_path)
+    db_name = database_name(db_path)
+    with conn:
+        prune_stale_entries(conn, cache_path, "gold_timings", db_name, db_fingerprint)
+        conn.execute(
+            "INSERT OR REPLACE INTO gold_timings VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                sql_hash(ground_truth),
+                db_name,
+                db_fingerprint,
+                host_signature(),
+                timer,
+                time.time(),
+                json.dumps([int(sample) for sample in samples]),
+            ),
+        )
+
+
+def load_execution(cache_path, predicted_sql, ground_truth, db_path, db_fingerprint, options):
+    """
+    Return the recorded outcome of a predicted query against a gold query as
+    a dict (outcome, predicted_digest, ground_truth_digest, time_budget,
+    error_class), or None if it was never executed.
+    """
+    conn = open_cache(cache_path)
+    row = conn.execute(
+        "SELECT outcome, predicted_digest, ground_truth_digest, time_budget, error_class "
+        "FROM executions WHERE sql_hash = ? AND gold_hash = ? AND db_name = ? "
+        "AND db_fingerprint = ? AND options = ?",
+        (
+            sql_hash(normalize_sql(predicted_sql)),
+            sql_hash(ground_truth),
+            database_name(db_path),
+            db_fingerprint,
+            options,
+        ),
+    ).fetchone()
+    if row is None:
+        return None
+    return dict(
+        zip(
+            ("outcome", "predicted_digest", "ground_truth_digest", "time_budget", "error_class"),
+            row,
+        )
+    )
+
+
+def store_execution(
+    cache_path,
+    predicted_sql,
+    ground_truth,
+    db_path,
+    db_fingerprint,
+    options,
+    outcome,
+    predicted_digest=None,
+    ground_truth_digest=None,
+    time_budget=None,
+    error_class=None,
+):
+    conn = open_cache(cache_path)
+    db_name = database_name(db_path)
+    with conn:
+        prune_stale_entries(conn, cache_path, "executions", db_name, db_fingerprint)
+        conn.execute(
+            "INSERT OR REPLACE INTO executions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                sql_hash(normalize_sql(predicted_sql)),
+                sql_hash(ground_truth),
+                db_name,
+                db_fingerprint,
+                options,
+                outcome,
+                predicted_digest,
+                ground_truth_digest,
+                time_budget,
+                error_class,
+            ),
+        )
+
+
+def pair_hashes(query_pairs, db_places, sql_dialect, settings):
+    """
+    Hash every (predicted SQL, gold SQL) pair together with its index, its
+    database and the metric settings, so a pair hashes the same only if
+    scoring it again would give the same result.
+    """
+    fingerprints = {}
+    hashes = []
+    for i, ((predicted_sql, ground_truth), db_place) in enumerate(zip(query_pairs, db_places)):
+        if db_place not in fingerprints:
+            fingerprints[db_place] = database_fingerprint(sql_dialect, db_place)
+        key = json.dumps(
+            [
+                i,
+                predicted_sql,
+                ground_truth,
+                database_name(db_place),
+                fingerprints[db_place],
+                settings,
+            ],
+            sort_keys=True,
+        )
+        hashes.append(hashlib.sha256(key.encode("utf-8")).hexdigest())
+    return hashes
+
+
+def load_scored_pairs(store_path, hashes):
+    """Return the stored results of the given pair hashes, keyed by sql_idx."""
+    conn = open_cache(store_path)
+    results = {}
+    for i, pair_hash in enumerate(hashes):
+        row = conn.execute(
+            "SELECT result FROM scored_pairs WHERE pair_hash = ?", (pair_hash,)
+        ).fetchone()
+        if row is not None:
+            results[i] = json.loads(row[0])
+    return results
+
+
+def store_scored_pairs(store_path, hashes, results):
+    conn = open_cache(store_path)
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO scored_pairs VALUES (?, ?)",
+            [(hashes[result["sql_idx"]], json.dumps(result)) for result in results],
+        )
+
+
+def close_caches():
+    for conn in _cache_connections.values():
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _cache_connections.clear()
@@ -0,0 +1,125 @@
+"""
+Order-independent digests of query result sets.
+
+Every row is encoded canonically and hashed to a 128-bit integer; a result
+digest is the number of rows hashed together with the sum of their hashes
+modulo 2**128, so it can be computed incrementally while rows stream in and
+does not depend on row order. By default duplicate rows are hashed once,
+which matches the set() comparison calculate_ex has always used.
+
+Values are encoded so that digests agree with Python equality for the types
+the database drivers return (1, 1.0 and True hash alike, "1" does not), and
+an optional normalizer can fold values together first, e.g. to round floats
+or to give NULLs a fixed value.
+"""
+import hashlib
+import math
+from decimal import Decimal
+
+DIGEST_BYTES = 16
+DIGEST_MASK = (1 << (8 * DIGEST_BYTES)) - 1
+
+
+def make_normalizer(float_precision=None, null_value=None):
+    """
+    Build a value normalizer: floats (and Decimals) are rounded to
+    float_precision digits and NULLs are replaced by null_value when those are
+    given. Returns None when there is nothing to normalize.
+    """
+    if float_precision is None and null_value is None:
+        return None
+
+    def normalize(value):
+        if value is None:
+            return null_value
+        if float_precision is not None and isinstance(value, (float, Decimal)):
+            return round(float(value), float_precision)
+        return value
+
+    return normalize
+
+
+def normalizer_tag(float_precision=None, null_value=None):
+    """Describe a normalizer so digests computed with different options are never mixed."""
+    return f"float_precision={float_precision};null_value={null_value!r}"
+
+
+def encode_value(value):
+    if value is None:
+        return b"N"
+    if isinstance(value, (bool, int)):
+        return b"i" + str(int(value)).encode()
+    if isinstance(value, float):
+        if math.isfinite(value) and value.is_integer():
+            return b"i" + str(int(value)).encode()
+        return b"f" + repr(value).encode()
+    if isinstance(value, Decimal):
+        if value.is_finite() and value == value.to_integral_value():
+            return b"i" + str(int(value)).encode()
+        if float(value) == value:
+            return encode_value(float(value))
+        return b"d" + str(value.normalize()).encode()
+    if isinstance(value, str):
+        return b"s" + value.encode("utf-8", "surrogatepass")
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return b"b" + bytes(value)
+    return b"o" + type(value).__name__.encode() + b":" + repr(value).encode()
+
+
+def row_hash(row, normalize=None):
+    hasher = hashlib.blake2b(digest_size=DIGEST_BYTES)
+    for value in row:
+        if normalize is not None:
+            value = normalize(value)
+        encoded = encode_value(value)
+        # length-prefix every value so ("ab", "c") and ("a", "bc") differ
+        hasher.update(len(encoded).to_bytes(4, "little"))
+        hasher.update(encoded)
+    return int.from_bytes(hasher.digest(), "big")
+
+
+class ResultDigest:
+    """Incrementally computed, order-independent digest of a result set."""
+
+    def __init__(self, distinct=True, normalize=None):
+        self.distinct = distinct
+        self.normalize = normalize
+        self.row_hashes = set()
+        self.count = 0
+        self.total = 0
+
+    def update(self, row):
+        """Add a row and return its hash."""
+        value = row_hash(row, self.normalize)
+        if self.distinct:
+            if value in self.row_hashes:
+                return value
+            self.row_hashes.add(value)
+        self.count += 1
+        self.total = (self.total + value) & DIGEST_MASK
+        return value
+
+    def update_rows(self, rows):
+        for row in rows:
+            self.update(row)
+        return self
+
+    def hexdigest(self):
+        return "{:x}-{:0{width}x}".format(self.count, self.total, width=2 * DIGEST_BYTES)
+
+    def __eq__(self, other):
+        if not isinstance(other, ResultDigest):
+            return NotImplemented
+        return self.hexdigest() == other.hexdigest()
+
+
+def pack_row_hashes(row_hashes):
+    """Serialize a set of row hashes into a compact, sorted byte string."""
+    return b"".join(value.to_bytes(DIGEST_BYTES, "big") for value in sorted(row_hashes))
+
+
+def unpack_row_hashes(blob):
+    return {
+        int.from_bytes(blob[i : i + DIGEST_BYTES], "big")
+        for i in range(0, len(blob), DIGEST_BYTES)
+    }
@@ -121,3 +121,16 @@ python3 -u "$SCRIPT_DIR/evaluation_ex.py" --db_root_path "${db_root_path}" --pre
 # python3 -u "$SCRIPT_DIR/evaluation_f1.py" --db_root_path "${db_root_path}" --predicted_sql_path "${predicted_sql_path}" \
 # --ground_truth_path "${ground_truth_path}" --num_cpus ${num_cpus} --output_log_path "${output_log_path}" \
 # --diff_json_path "${diff_json_path}" --meta_time_out ${meta_time_out} --sql_dialect "${sql_dialect}"
+
+
+# Alternatively, compute EX, Soft-F1 and R-VES in a single pass that executes each pred/gold pair once
+# echo "Starting to compare with knowledge for ex, soft-f1 and R-VES, sql_dialect: ${sql_dialect}"
+# python3 -u "$SCRIPT_DIR/evaluation_all.py" --db_root_path "${db_root_path}" --predicted_sql_path "${predicted_sql_path}" \
+# --ground_truth_path "${ground_truth_path}" --num_cpus ${num_cpus} --output_log_path "${output_log_path}" \
+# --diff_json_path "${diff_json_path}" --meta_time_out ${meta_time_out} --sql_dialect "${sql_dialect}"
+
+
+# To score every prediction file in a directory (one table per model plus a leaderboard) in one run
+# python3 -u "$SCRIPT_DIR/evaluation_batch.py" --db_root_path "${db_root_path}" --predicted_sql_paths "$PROJECT_ROOT/llm/exp_result/sql_output_kg" \
+# --ground_truth_path "${ground_truth_path}" --num_cpus ${num_cpus} --output_log_path "$PROJECT_ROOT/eval_result/batch.txt" \
+# --diff_json_path "${diff_json_path}" --meta_time_out ${meta_time_out} --sql_dialect "${sql_dialect}"
@@ -0,0 +1,44 @@
+eval_path='../../sqlite/mini_dev_sqlite.json'
+db_root_path='./../dev_data/dev_20240627/dev_databases/'
+# gold SQL and difficulties of the questions in eval_path, in the same order
+ground_truth_path='../../sqlite/mini_dev_sqlite_gold.sql'
+diff_json_path='../../sqlite/mini_dev_sqlite.jsonl'
+use_knowledge='True'
+mode='mini_dev' # dev, train, mini_dev
+cot='True'
+
+# Replace with your API key - must have access to the model specified below
+YOUR_API_KEY='******' # Add your API key here before running
+
+# Model name - see run_gpt.sh for how it is used to build the API URL
+engine='inf-2-0-32b-sql' # Replace with your model name
+
+# Threads generating SQL and processes evaluating it; evaluation starts as soon as
+# the first SQL is generated, so the run takes about as long as the slower side
+num_threads=4
+num_cpus=16
+meta_time_out=30.0
+
+# Choose the SQL dialect to run, e.g. SQLite, MySQL, PostgreSQL
+sql_dialect='SQLite'
+
+# Choose the output path for the generated SQL queries
+data_kg_output_path='./exp_result/sql_output_kg/'
+mkdir -p ${data_kg_output_path}
+
+echo "Generate and evaluate SQL with model: $engine, threads: $num_threads, cpus: $num_cpus, knowledge: $use_knowledge, chain of thought: $cot"
+python3 -u ../src/pipeline.py \
+  --db_root_path ${db_root_path} \
+  --api_key ${YOUR_API_KEY} \
+  --mode ${mode} \
+  --engine ${engine} \
+  --eval_path ${eval_path} \
+  --data_output_path ${data_kg_output_path} \
+  --use_knowledge ${use_knowledge} \
+  --chain_of_thought ${cot} \
+  --num_processes ${num_threads} \
+  --sql_dialect ${sql_dialect} \
+  --ground_truth_path ${ground_truth_path} \
+  --diff_json_path ${diff_json_path} \
+  --num_cpus ${num_cpus} \
+  --meta_time_out ${meta_time_out}
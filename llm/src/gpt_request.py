@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import json
 import os
-from openai import OpenAI
+import sys
+from openai import OpenAI, AsyncOpenAI, APIStatusError, APIConnectionError
 from tqdm import tqdm
 import time
 from concurrent.futures import ThreadPoolExecutor
 import concurrent.futures
 
 from prompt import generate_combined_prompts_one
+from table_schema import set_schema_cache_dir
+from rate_limit import RateLimiter, backoff_delay, retry_after_seconds
+from response_cache import (
+    CACHE_MODES,
+    configure_response_cache,
+    close_response_cache,
+    lookup_response,
+    store_response,
+    response_text,
+)
 
 
 """openai configure"""
@@ -21,6 +33,12 @@ api_version = "2024-02-01"
 # - For custom LLM endpoints: api_base = "https://your-endpoint.com"
 api_base = os.environ.get("API_BASE", "https://layercake.nvda-staging2.inf7ll8.com/iai-enterprise")
 
+# Completion settings of every generation request
+MAX_TOKENS = 512
+TEMPERATURE = 0
+STOP = ["--", "\n\n", ";", "#"]
+
+
 def new_directory(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -62,6 +80,62 @@ def connect_gpt(engine, prompt, max_tokens, temperature, stop, client):
     return result
 
 
+# Status codes worth retrying besides server errors: timeouts, conflicts and rate limits
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+async def connect_gpt_async(
+    engine, prompt, max_tokens, temperature, stop, client, limiter, max_retries=10
+):
+    """
+    Async counterpart of connect_gpt. Instead of fixed sleeps, every attempt
+    waits for the rate limiter, the limiter follows the rate-limit headers of
+    each response, and throttled or failed requests are retried with jittered
+    exponential backoff that honors Retry-After.
+    """
+    # about 4 characters per prompt token, plus the completion budget
+    tokens = len(prompt) // 4 + max_tokens
+    result = None
+    for attempt in range(max_retries):
+        await limiter.acquire(tokens)
+        try:
+            if engine == "gpt-35-turbo-instruct":
+                raw = await client.completions.with_raw_response.create(
+                    model="gpt-3.5-turbo-instruct",
+                    prompt=prompt,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    stop=stop,
+                )
+                limiter.update_from_headers(raw.headers)
+                return raw.parse().choices[0].text
+            messages = [
+                {"role": "user", "content": prompt},
+            ]
+            raw = await client.chat.completions.with_raw_response.create(
+                model=engine,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stop=stop,
+            )
+            limiter.update_from_headers(raw.headers)
+            return raw.parse()
+        except APIStatusError as e:
+            result = "error:{}".format(e)
+            print(result)
+            limiter.update_from_headers(e.response.headers)
+            if e.status_code not in RETRYABLE_STATUS and e.status_code < 500:
+                return result
+            delay = backoff_delay(attempt, retry_after_seconds(e.response.headers))
+        except APIConnectionError as e:
+            result = "error:{}".format(e)
+            print(result)
+            delay = backoff_delay(attempt)
+        await asyncio.sleep(delay)
+    return result
+
+
 def decouple_question_schema(datasets, db_root_path):
     question_list = []
     db_path_list = []
@@ -92,7 +166,7 @@ def generate_sql_file(sql_lst, output_path=None):
     return result
 
 
-def init_client(api_key, api_version, engine):
+def init_client(api_key, api_version, engine, client_class=OpenAI, **client_kwargs):
     """
     Initialize the OpenAI client with custom base URL support.
     
@@ -107,25 +181,28 @@ def init_client(api_key, api_version, engine):
     - "custom": Custom endpoint format with model in path
     
     You can override the base URL with the API_BASE environment variable.
+    Pass client_class=AsyncOpenAI (and any extra client options) for the
+    async engine.
     """
     api_format = os.environ.get("API_BASE_FORMAT", "custom")
     
     if api_format == "openai":
         # Standard OpenAI format
-        client = OpenAI(api_key=api_key, base_url=f"{api_base}/v1")
+        client = client_class(api_key=api_key, base_url=f"{api_base}/v1", **client_kwargs)
         print(f"Using OpenAI format: {api_base}/v1")
     elif api_format == "azure":
         # Azure OpenAI format
-        client = OpenAI(
+        client = client_class(
             api_key=api_key,
             base_url=f"{api_base}/openai/deployments/{engine}",
-            api_version=api_version
+            api_version=api_version,
+            **client_kwargs
         )
         print(f"Using Azure format: {api_base}/openai/deployments/{engine}")
     else:
         # Custom format with model in path
         base_url = f"{api_base}/{engine}/v1"
-        client = OpenAI(api_key=api_key, base_url=base_url)
+        client = client_class(api_key=api_key, base_url=base_url, **client_kwargs)
         print(f"Using custom format: {base_url}")
     
     return client
@@ -144,33 +221,54 @@ def worker_function(question_data):
     generate the prompt, and collect the GPT response.
     """
     prompt, engine, client, db_path, question, i = question_data
-    response = connect_gpt(engine, prompt, 512, 0, ["--", "\n\n", ";", "#"], client)
+    response = lookup_response(engine, prompt, MAX_TOKENS, TEMPERATURE, STOP)
+    if response is None:
+        response = connect_gpt(engine, prompt, MAX_TOKENS, TEMPERATURE, STOP, client)
+        store_response(engine, prompt, MAX_TOKENS, TEMPERATURE, STOP, response)
+    if response_text(response) is None:
+        # out of retries: no SQL, so the question stays unanswered and is asked again on resume
+        print(f"No response for {i}th question: {question}")
+        return None, i
     sql = post_process_response(response, db_path)
     print(f"Processed {i}th question: {question}")
     return sql, i
 
 
-def collect_response_from_gpt(
+async def worker_function_async(question_data, limiter, semaphore):
+    """Async counterpart of worker_function; semaphore bounds the requests in flight."""
+    prompt, engine, client, db_path, question, i = question_data
+    response = lookup_response(engine, prompt, MAX_TOKENS, TEMPERATURE, STOP)
+    if response is None:
+        async with semaphore:
+            response = await connect_gpt_async(
+                engine, prompt, MAX_TOKENS, TEMPERATURE, STOP, client, limiter
+            )
+        store_response(engine, prompt, MAX_TOKENS, TEMPERATURE, STOP, response)
+    if response_text(response) is None:
+        # out of retries: no SQL, so the question stays unanswered and is asked again on resume
+        print(f"No response for {i}th question: {question}")
+        return None, i
+    sql = post_process_response(response, db_path)
+    print(f"Processed {i}th question: {question}")
+    return sql, i
+
+
+def prepare_tasks(
     db_path_list,
     question_list,
-    api_key,
     engine,
     sql_dialect,
-    num_threads=3,
+    client,
     knowledge_list=None,
+    skip_indices=(),
 ):
-    """
-    Collect responses from GPT using multiple threads.
-    """
-    client = init_client(api_key, api_version, engine)
-
-    tasks = [
+    return [
         (
             generate_combined_prompts_one(
                 db_path=db_path_list[i],
                 question=question_list[i],
                 sql_dialect=sql_dialect,
-                knowledge=knowledge_list[i],
+                knowledge=knowledge_list[i] if knowledge_list else None,
             ),
             engine,
             client,
@@ -179,7 +277,93 @@ def collect_response_from_gpt(
             i,
         )
         for i in range(len(question_list))
+        if i not in skip_indices
     ]
+
+
+async def collect_response_async(
+    db_path_list,
+    question_list,
+    api_key,
+    engine,
+    sql_dialect,
+    max_concurrency=16,
+    knowledge_list=None,
+    rpm=None,
+    tpm=None,
+    checkpoint_file=None,
+    skip_indices=(),
+):
+    """
+    Collect responses with the async OpenAI client. Throughput is bounded by
+    the RPM/TPM limits (and the server's rate-limit headers) rather than by a
+    thread count; max_concurrency only caps the requests in flight. Like
+    collect_response_from_gpt, finished responses go to checkpoint_file as
+    they arrive and questions in skip_indices are not asked again.
+    """
+    client = init_client(api_key, api_version, engine, AsyncOpenAI, max_retries=0)
+    limiter = RateLimiter(rpm, tpm)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = prepare_tasks(
+        db_path_list,
+        question_list,
+        engine,
+        sql_dialect,
+        client,
+        knowledge_list,
+        skip_indices,
+    )
+    responses = []
+    try:
+        for future in tqdm(
+            asyncio.as_completed(
+                [worker_function_async(task, limiter, semaphore) for task in tasks]
+            ),
+            total=len(tasks),
+        ):
+            try:
+                sql, i = await future
+            except Exception as e:
+                # the question stays missing from the checkpoint and is asked again on resume
+                print("error:{}".format(e))
+                continue
+            if sql is None:
+                continue
+            responses.append((sql, i))
+            if checkpoint_file is not None:
+                append_prediction(checkpoint_file, sql, i)
+    finally:
+        await client.close()
+    return responses
+
+
+def collect_response_from_gpt(
+    db_path_list,
+    question_list,
+    api_key,
+    engine,
+    sql_dialect,
+    num_threads=3,
+    knowledge_list=None,
+    checkpoint_file=None,
+    skip_indices=(),
+):
+    """
+    Collect responses from GPT using multiple threads. Every response is
+    appended to checkpoint_file as soon as it arrives, and questions in
+    skip_indices (answered by an earlier, interrupted run) are not asked again.
+    """
+    client = init_client(api_key, api_version, engine)
+
+    tasks = prepare_tasks(
+        db_path_list,
+        question_list,
+        engine,
+        sql_dialect,
+        client,
+        knowledge_list,
+        skip_indices,
+    )
     responses = []
     with ThreadPoolExecutor(max_workers=num_threads) as executor:
         future_to_task = {
@@ -188,10 +372,110 @@ def collect_response_from_gpt(
         for future in tqdm(
             concurrent.futures.as_completed(future_to_task), total=len(tasks)
         ):
-            responses.append(future.result())
+            try:
+                sql, i = future.result()
+            except Exception as e:
+                # the question stays missing from the checkpoint and is asked again on resume
+                print("error:{}".format(e))
+                continue
+            if sql is None:
+                continue
+            responses.append((sql, i))
+            if checkpoint_file is not None:
+                append_prediction(checkpoint_file, sql, i)
     return responses
 
 
+def prediction_output_name(data_output_path, mode, engine, sql_dialect, chain_of_thought):
+    if chain_of_thought == "True":
+        return (
+            data_output_path
+            + "predict_"
+            + mode
+            + "_"
+            + engine
+            + "_cot"
+            + "_"
+            + sql_dialect
+            + ".json"
+        )
+    return (
+        data_output_path
+        + "predict_"
+        + mode
+        + "_"
+        + engine
+        + "_"
+        + sql_dialect
+        + ".json"
+    )
+
+
+def prediction_checkpoint_path(output_name):
+    return output_name[: -len(".json")] + ".checkpoint.jsonl"
+
+
+def prediction_header(args):
+    """First line of a prediction checkpoint: the settings its answers depend on."""
+    return {
+        "eval_path": args.eval_path,
+        "use_knowledge": args.use_knowledge,
+        "engine": args.engine,
+        "chain_of_thought": args.chain_of_thought,
+        "sql_dialect": args.sql_dialect,
+    }
+
+
+def load_predictions(checkpoint_path, header):
+    """{idx: sql} of the predictions stored in a checkpoint by an earlier run."""
+    predictions = {}
+    if not os.path.exists(checkpoint_path):
+        return predictions
+    checkpoint_header = None
+    with open(checkpoint_path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of an interrupted run may be cut short
+                continue
+            if checkpoint_header is None:
+                checkpoint_header = record
+                if checkpoint_header != header:
+                    raise ValueError(
+                        f"Checkpoint {checkpoint_path} was written by a different run: "
+                        f"{checkpoint_header} != {header}"
+                    )
+                continue
+            predictions[record["idx"]] = record["sql"]
+    return predictions
+
+
+def open_prediction_checkpoint(checkpoint_path, header):
+    """Open a prediction checkpoint for appending, writing the header if it is new."""
+    directory_path = os.path.dirname(checkpoint_path)
+    if directory_path:
+        new_directory(directory_path)
+    checkpoint_file = open(checkpoint_path, "a+")
+    checkpoint_file.seek(0, os.SEEK_END)
+    if checkpoint_file.tell() == 0:
+        checkpoint_file.write(json.dumps(header) + "\n")
+    else:
+        # start on a fresh line if the previous run stopped mid-write
+        checkpoint_file.seek(checkpoint_file.tell() - 1)
+        if checkpoint_file.read(1) != "\n":
+            checkpoint_file.write("\n")
+    checkpoint_file.flush()
+    return checkpoint_file
+
+
+def append_prediction(checkpoint_file, sql, i):
+    checkpoint_file.write(json.dumps({"idx": i, "sql": sql}) + "\n")
+    checkpoint_file.flush()
+
+
 if __name__ == "__main__":
     args_parser = argparse.ArgumentParser()
     args_parser.add_argument("--eval_path", type=str, default="")
@@ -207,7 +491,30 @@ if __name__ == "__main__":
     args_parser.add_argument("--chain_of_thought", type=str)
     args_parser.add_argument("--num_processes", type=int, default=3)
     args_parser.add_argument("--sql_dialect", type=str, default="SQLite")
+    # directory keeping schema prompts across runs (SQLite; refreshed when a database changes)
+    args_parser.add_argument("--schema_cache_dir", type=str, default="")
+    # "async" generates with the async client, limited by --rpm/--tpm instead of threads
+    args_parser.add_argument(
+        "--engine_mode", type=str, default="thread", choices=["thread", "async"]
+    )
+    # requests / tokens per minute for the async engine; 0 learns them from rate-limit headers
+    args_parser.add_argument("--rpm", type=int, default=0)
+    args_parser.add_argument("--tpm", type=int, default=0)
+    # most requests the async engine keeps in flight
+    args_parser.add_argument("--max_concurrency", type=int, default=16)
+    # SQLite file caching responses by (engine, prompt, max_tokens, temperature, stop)
+    args_parser.add_argument("--response_cache_path", type=str, default="")
+    args_parser.add_argument(
+        "--response_cache_mode", type=str, default="write_through", choices=list(CACHE_MODES)
+    )
+    args_parser.add_argument("--response_cache_max_mb", type=int, default=1024)
     args = args_parser.parse_args()
+    set_schema_cache_dir(args.schema_cache_dir)
+    configure_response_cache(
+        args.response_cache_path,
+        args.response_cache_mode,
+        args.response_cache_max_mb * 1024 * 1024,
+    )
 
     eval_data = json.load(open(args.eval_path, "r"))
 
@@ -216,7 +523,34 @@ if __name__ == "__main__":
     )
     assert len(question_list) == len(db_path_list) == len(knowledge_list)
 
-    if args.use_knowledge == "True":
+    output_name = prediction_output_name(
+        args.data_output_path, args.mode, args.engine, args.sql_dialect, args.chain_of_thought
+    )
+    # responses stream into this file and survive crashes; it becomes output_name once complete
+    checkpoint_path = prediction_checkpoint_path(output_name)
+    header = prediction_header(args)
+    predictions = load_predictions(checkpoint_path, header)
+    if predictions:
+        print(f"Resuming with {len(predictions)} answered questions from {checkpoint_path}")
+    checkpoint_file = open_prediction_checkpoint(checkpoint_path, header)
+
+    if args.engine_mode == "async":
+        responses = asyncio.run(
+            collect_response_async(
+                db_path_list,
+                question_list,
+                args.api_key,
+                args.engine,
+                args.sql_dialect,
+                args.max_concurrency,
+                knowledge_list if args.use_knowledge == "True" else None,
+                args.rpm,
+                args.tpm,
+                checkpoint_file=checkpoint_file,
+                skip_indices=predictions,
+            )
+        )
+    elif args.use_knowledge == "True":
         responses = collect_response_from_gpt(
             db_path_list,
             question_list,
@@ -225,6 +559,8 @@ if __name__ == "__main__":
             args.sql_dialect,
             args.num_processes,
             knowledge_list,
+            checkpoint_file=checkpoint_file,
+            skip_indices=predictions,
         )
     else:
         responses = collect_response_from_gpt(
@@ -234,32 +570,24 @@ if __name__ == "__main__":
             args.engine,
             args.sql_dialect,
             args.num_processes,
+            checkpoint_file=checkpoint_file,
+            skip_indices=predictions,
         )
+    checkpoint_file.close()
+    close_response_cache()
 
-    if args.chain_of_thought == "True":
-        output_name = (
-            args.data_output_path
-            + "predict_"
-            + args.mode
-            + "_"
-            + args.engine
-            + "_cot"
-            + "_"
-            + args.sql_dialect
-            + ".json"
+    for sql, i in responses:
+        predictions[i] = sql
+    if len(predictions) < len(question_list):
+        print(
+            f"{len(question_list) - len(predictions)} questions are still unanswered; "
+            f"rerun to resume from {checkpoint_path}"
         )
-    else:
-        output_name = (
-            args.data_output_path
-            + "predict_"
-            + args.mode
-            + "_"
-            + args.engine
-            + "_"
-            + args.sql_dialect
-            + ".json"
-        )
-    generate_sql_file(sql_lst=responses, output_path=output_name)
+        sys.exit(1)
+    generate_sql_file(
+        sql_lst=[(sql, i) for i, sql in predictions.items()], output_path=output_name
+    )
+    os.remove(checkpoint_path)
 
     print(
         "successfully collect results from {} for {} evaluation; SQL dialect {} Use knowledge: {}; Use COT: {}".format(
@@ -0,0 +1,252 @@
+"""
+Generate-then-evaluate pipeline: SQL generation (gpt_request.py) and EX
+evaluation (evaluation_ex.py) in one run.
+
+Every SQL coming out of worker_function is handed to a pool of evaluation
+workers right away and scored with evaluation_ex.execute_model while the
+remaining questions are still being generated, so a run takes about as long
+as the slower of the two stages instead of both back to back. EX per
+difficulty is printed as results come in. Predictions stream into the same
+checkpoint gpt_request.py uses: an interrupted run resumes by scoring the
+stored predictions first and generating only the missing ones, and the
+predict file is written once every question is answered.
+"""
+import os
+import sys
+import json
+import argparse
+import threading
+import concurrent.futures
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+
+# the evaluation scripts are flat modules importing each other by name
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "evaluation")
+)
+
+from gpt_request import (
+    api_version,
+    init_client,
+    decouple_question_schema,
+    prepare_tasks,
+    worker_function,
+    generate_sql_file,
+    prediction_output_name,
+    prediction_checkpoint_path,
+    prediction_header,
+    load_predictions,
+    open_prediction_checkpoint,
+    append_prediction,
+)
+from table_schema import set_schema_cache_dir
+from response_cache import CACHE_MODES, configure_response_cache, close_response_cache
+from evaluation_utils import (
+    load_jsonl,
+    package_sqls,
+    clean_predicted_sql,
+    sort_results,
+    print_data,
+    init_worker,
+    SQLITE_MODES,
+    MAX_SNAPSHOT_BYTES,
+)
+from evaluation_ex import execute_model, compute_acc_by_diff
+
+DIFFICULTIES = ("simple", "moderate", "challenging")
+
+exec_result = []
+# difficulty of every question, used for the live stats
+difficulties = []
+num_questions = 0
+_stats_lock = threading.Lock()
+
+
+def live_stats(results):
+    """One line of running EX per difficulty over the results scored so far."""
+    parts = []
+    for difficulty in DIFFICULTIES:
+        scores = [
+            result["res"]
+            for result in results
+            if difficulties[result["sql_idx"]] == difficulty
+        ]
+        if scores:
+            parts.append(f"{difficulty} {100 * sum(scores) / len(scores):.2f} ({len(scores)})")
+    total = 100 * sum(result["res"] for result in results) / len(results)
+    parts.append(f"total {total:.2f}")
+    return f"[EX {len(results)}/{num_questions}] " + "  ".join(parts)
+
+
+def result_callback(result):
+    # runs in the pool's result thread while the main thread keeps generating
+    with _stats_lock:
+        exec_result.append(result)
+        print(live_stats(exec_result))
+
+
+def submit_evaluation(pool, sql, i, gt_queries, db_paths_gt, args):
+    predicted_sql, _ = clean_predicted_sql(sql)
+    pool.apply_async(
+        execute_model,
+        args=(
+            predicted_sql,
+            gt_queries[i],
+            db_paths_gt[i],
+            i,
+            args.meta_time_out,
+            args.sql_dialect,
+            args.gold_cache_path,
+        ),
+        callback=result_callback,
+    )
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--eval_path", type=str, default="")
+    args_parser.add_argument("--mode", type=str, default="dev")
+    args_parser.add_argument("--use_knowledge", type=str, default="False")
+    args_parser.add_argument("--db_root_path", type=str, default="")
+    args_parser.add_argument("--api_key", type=str, required=True)
+    args_parser.add_argument(
+        "--engine", type=str, required=True, default="code-davinci-002"
+    )
+    args_parser.add_argument("--data_output_path", type=str)
+    args_parser.add_argument("--chain_of_thought", type=str)
+    # generation threads
+    args_parser.add_argument("--num_processes", type=int, default=3)
+    args_parser.add_argument("--sql_dialect", type=str, default="SQLite")
+    # directory keeping schema prompts across runs (SQLite; refreshed when a database changes)
+    args_parser.add_argument("--schema_cache_dir", type=str, default="")
+    # SQLite file caching responses by (engine, prompt, max_tokens, temperature, stop)
+    args_parser.add_argument("--response_cache_path", type=str, default="")
+    args_parser.add_argument(
+        "--response_cache_mode", type=str, default="write_through", choices=list(CACHE_MODES)
+    )
+    args_parser.add_argument("--response_cache_max_mb", type=int, default=1024)
+    # gold SQL file (one "SQL\tdb_id" line per question of --eval_path, in the same order)
+    args_parser.add_argument("--ground_truth_path", type=str, required=True)
+    # difficulty of every question; --eval_path is used when it has a "difficulty" field
+    args_parser.add_argument("--diff_json_path", type=str, default="")
+    # evaluation worker processes
+    args_parser.add_argument("--num_cpus", type=int, default=1)
+    args_parser.add_argument("--meta_time_out", type=float, default=30.0)
+    # SQLite file caching gold results across runs (SQLite dialect only)
+    args_parser.add_argument("--gold_cache_path", type=str, default="")
+    # "readonly" opens SQLite files immutable with mmap and rejects writes,
+    # "memory" runs every query against a per-worker in-memory copy of the database
+    args_parser.add_argument(
+        "--sqlite_mode", type=str, default="file", choices=list(SQLITE_MODES)
+    )
+    # most MB of databases a worker keeps as in-memory snapshots with --sqlite_mode memory
+    args_parser.add_argument(
+        "--max_snapshot_mb", type=int, default=MAX_SNAPSHOT_BYTES // (1024 * 1024)
+    )
+    args_parser.add_argument("--output_log_path", type=str, default=None)
+    args = args_parser.parse_args()
+    set_schema_cache_dir(args.schema_cache_dir)
+    configure_response_cache(
+        args.response_cache_path,
+        args.response_cache_mode,
+        args.response_cache_max_mb * 1024 * 1024,
+    )
+
+    eval_data = json.load(open(args.eval_path, "r"))
+    question_list, db_path_list, knowledge_list = decouple_question_schema(
+        datasets=eval_data, db_root_path=args.db_root_path
+    )
+    # evaluation reads database paths the way evaluation_ex.py does
+    gt_queries, db_paths_gt = package_sqls(
+        args.ground_truth_path, args.db_root_path, mode="gt"
+    )
+    if len(gt_queries) < len(question_list):
+        args_parser.error(
+            f"{args.ground_truth_path} has {len(gt_queries)} queries for {len(question_list)} questions"
+        )
+    diff_contents = load_jsonl(args.diff_json_path) if args.diff_json_path else eval_data
+    difficulties = [
+        diff_contents[i].get("difficulty", "moderate") if i < len(diff_contents) else "moderate"
+        for i in range(len(question_list))
+    ]
+    num_questions = len(question_list)
+
+    output_name = prediction_output_name(
+        args.data_output_path, args.mode, args.engine, args.sql_dialect, args.chain_of_thought
+    )
+    checkpoint_path = prediction_checkpoint_path(output_name)
+    header = prediction_header(args)
+    predictions = load_predictions(checkpoint_path, header)
+    checkpoint_file = open_prediction_checkpoint(checkpoint_path, header)
+
+    pool = mp.Pool(
+        processes=args.num_cpus,
+        initializer=init_worker,
+        initargs=(args.sqlite_mode, args.max_snapshot_mb * 1024 * 1024),
+    )
+    if predictions:
+        # predictions of an interrupted run are scored while the rest is generated
+        print(f"Resuming with {len(predictions)} answered questions from {checkpoint_path}")
+        for i, sql in predictions.items():
+            submit_evaluation(pool, sql, i, gt_queries, db_paths_gt, args)
+
+    client = init_client(args.api_key, api_version, args.engine)
+    tasks = prepare_tasks(
+        db_path_list,
+        question_list,
+        args.engine,
+        args.sql_dialect,
+        client,
+        knowledge_list if args.use_knowledge == "True" else None,
+        skip_indices=predictions,
+    )
+    with ThreadPoolExecutor(max_workers=args.num_processes) as executor:
+        futures = [executor.submit(worker_function, task) for task in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                sql, i = future.result()
+            except Exception as e:
+                # the question stays missing from the checkpoint and is asked again on resume
+                print("error:{}".format(e))
+                continue
+            if sql is None:
+                continue
+            predictions[i] = sql
+            append_prediction(checkpoint_file, sql, i)
+            submit_evaluation(pool, sql, i, gt_queries, db_paths_gt, args)
+    checkpoint_file.close()
+    close_response_cache()
+    print("Generation finished; waiting for the remaining evaluations")
+    pool.close()
+    pool.join()
+
+    if len(predictions) < len(question_list):
+        print(
+            f"{len(question_list) - len(predictions)} questions are still unanswered; "
+            f"rerun to resume from {checkpoint_path}"
+        )
+        sys.exit(1)
+    generate_sql_file(
+        sql_lst=[(sql, i) for i, sql in predictions.items()], output_path=output_name
+    )
+    os.remove(checkpoint_path)
+
+    exec_result = sort_results(exec_result)
+    print("start calculate EX")
+    simple_acc, moderate_acc, challenging_acc, acc, count_lists = compute_acc_by_diff(
+        exec_result, args.diff_json_path, diff_contents
+    )
+    score_lists = [simple_acc, moderate_acc, challenging_acc, acc]
+    print_data(score_lists, count_lists, metric="EX", result_log_file=args.output_log_path)
+    print(
+        "==========================================================================================="
+    )
+    print(
+        "Finished generation and EX evaluation of {} for {} evaluation; SQL dialect {} Use knowledge: {}; Use COT: {}".format(
+            args.engine,
+            args.mode,
+            args.sql_dialect,
+            args.use_knowledge,
+            args.chain_of_thought,
+        )
+    )
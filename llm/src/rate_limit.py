@@ -0,0 +1,155 @@
+"""
+Client-side rate limiting for the async generation engine in gpt_request.py.
+
+Requests and tokens are metered by two token buckets that refill continuously
+at the configured RPM/TPM. The x-ratelimit-* headers returned by the server
+adjust them as we go: a bucket is created from x-ratelimit-limit-* when no
+limit was configured, never holds more than the server says remains, and is
+emptied until the reset time once the server reports nothing left.
+Failed requests back off exponentially with full jitter, or wait as long as
+the server's Retry-After asks.
+"""
+import re
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+
+# Exponential backoff: first delay ceiling and largest delay, in seconds
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# Extra random wait on top of Retry-After so throttled requests do not return in lockstep
+RETRY_AFTER_JITTER = 0.5
+
+# Durations such as "1s", "6m0s", "20ms" or "1h2m3.5s" in x-ratelimit-reset-* headers
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def parse_duration(value):
+    """Seconds in a rate-limit reset duration, or None if it cannot be parsed."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after_seconds(headers):
+    """Seconds the server asks us to wait (retry-after-ms or retry-after), or None."""
+    if headers is None:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Delay before retry number attempt (0-based): the server's Retry-After plus
+    a little jitter when given, full-jitter exponential backoff otherwise.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, RETRY_AFTER_JITTER)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """Bucket of up to per_minute units that refills at per_minute / 60 units per second."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount units are available (requests larger than the bucket wait for a full one)."""
+        self.refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate) if self.rate > 0 else 0.0
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def sync(self, remaining=None, reset_seconds=None):
+        """Align the bucket with the server's view of what is left."""
+        self.refill()
+        if remaining is not None:
+            self.tokens = min(self.tokens, float(remaining))
+            if remaining <= 0 and reset_seconds:
+                # empty until the reset, then refill as usual
+                self.tokens = -reset_seconds * self.rate
+
+
+class RateLimiter:
+    """Request (RPM) and token (TPM) limits shared by all requests of a run."""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens=0):
+        """Wait until one request of about `tokens` tokens fits in both limits, then reserve it."""
+        while True:
+            async with self.lock:
+                wait = 0.0
+                if self.requests is not None:
+                    wait = max(wait, self.requests.wait_time(1))
+                if self.tokens is not None:
+                    wait = max(wait, self.tokens.wait_time(tokens))
+                if wait <= 0:
+                    if self.requests is not None:
+                        self.requests.take(1)
+                    if self.tokens is not None:
+                        self.tokens.take(tokens)
+                    return
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """Feed the x-ratelimit-* headers of a response into the buckets."""
+        if headers is None:
+            return
+        for name, attribute in (("requests", "requests"), ("tokens", "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{name}")
+            remaining = headers.get(f"x-ratelimit-remaining-{name}")
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{name}"))
+            bucket = getattr(self, attribute)
+            if bucket is None and limit is not None:
+                try:
+                    bucket = TokenBucket(float(limit))
+                except ValueError:
+                    continue
+                setattr(self, attribute, bucket)
+            if bucket is None or remaining is None:
+                continue
+            try:
+                bucket.sync(float(remaining), reset)
+            except ValueError:
+                continue
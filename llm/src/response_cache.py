@@ -0,0 +1,153 @@
+"""
+Content-addressed on-disk cache of LLM responses.
+
+Every response is stored under a hash of everything that determines it
+(engine, full prompt, max_tokens, temperature and stop sequences) in a single
+SQLite file, so re-running gpt_request.py on prompts it has already seen costs
+nothing. The cache is bounded in size: once it grows past its limit the least
+recently used responses are evicted. Error responses are never cached.
+
+Modes:
+    off            the cache is not used
+    read_only      hits are served, nothing is written (not even usage times)
+    write_through  hits are served, misses are stored after the request
+    refresh        every prompt is requested again and the stored response replaced
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_MODES = ("off", "read_only", "write_through", "refresh")
+# Default size limit of the cache file contents
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# After an eviction the cache is trimmed to this fraction of its limit
+EVICT_TO_FRACTION = 0.9
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    engine TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+_cache_conn = None
+_cache_mode = "off"
+_cache_max_bytes = DEFAULT_MAX_BYTES
+# Sum of the response sizes in the cache, summed once when it is opened for
+# writing and kept up to date by store_response and evict_responses
+_cache_total_bytes = 0
+# worker_function runs in several threads that share the one connection
+_cache_lock = threading.Lock()
+
+
+def configure_response_cache(cache_path, mode="write_through", max_bytes=DEFAULT_MAX_BYTES):
+    """Open the response cache for this process; an empty path or mode "off" disables it."""
+    global _cache_conn, _cache_mode, _cache_max_bytes, _cache_total_bytes
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unsupported response cache mode: {mode}")
+    close_response_cache()
+    if not cache_path or mode == "off":
+        _cache_mode = "off"
+        return
+    if mode == "read_only":
+        if not os.path.exists(cache_path):
+            raise FileNotFoundError(f"Response cache not found: {cache_path}")
+        conn = sqlite3.connect(f"file:{cache_path}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        directory_path = os.path.dirname(cache_path)
+        if directory_path and not os.path.exists(directory_path):
+            os.makedirs(directory_path, exist_ok=True)
+        conn = sqlite3.connect(cache_path, timeout=60, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(CACHE_SCHEMA)
+        conn.commit()
+        _cache_total_bytes = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+    _cache_conn = conn
+    _cache_mode = mode
+    _cache_max_bytes = max_bytes
+
+
+def close_response_cache():
+    global _cache_conn
+    if _cache_conn is not None:
+        _cache_conn.close()
+        _cache_conn = None
+
+
+def response_key(engine, prompt, max_tokens, temperature, stop):
+    key = json.dumps([engine, prompt, max_tokens, temperature, stop])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def response_text(response):
+    """The text of a response as connect_gpt returns it, or None for errors."""
+    if isinstance(response, str):
+        return None if response.startswith("error:") else response
+    try:
+        return response.choices[0].message.content
+    except (AttributeError, IndexError):
+        return None
+
+
+def lookup_response(engine, prompt, max_tokens, temperature, stop):
+    """Return the cached response text for a request, or None on a miss."""
+    if _cache_mode not in ("read_only", "write_through"):
+        return None
+    key = response_key(engine, prompt, max_tokens, temperature, stop)
+    with _cache_lock:
+        row = _cache_conn.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None and _cache_mode == "write_through":
+            with _cache_conn:
+                _cache_conn.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+                )
+    return row[0] if row is not None else None
+
+
+def store_response(engine, prompt, max_tokens, temperature, stop, response):
+    global _cache_total_bytes
+    if _cache_mode not in ("write_through", "refresh"):
+        return
+    text = response_text(response)
+    if text is None:
+        return
+    key = response_key(engine, prompt, max_tokens, temperature, stop)
+    size = len(text.encode("utf-8"))
+    with _cache_lock:
+        with _cache_conn:
+            # a refreshed response replaces the stored one
+            replaced = _cache_conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            _cache_conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, engine, text, size, time.time()),
+            )
+            _cache_total_bytes += size - (replaced[0] if replaced is not None else 0)
+            evict_responses()
+
+
+def evict_responses():
+    """Delete least recently used responses once the cache outgrows its limit."""
+    global _cache_total_bytes
+    if _cache_total_bytes <= _cache_max_bytes:
+        return
+    target = _cache_max_bytes * EVICT_TO_FRACTION
+    for key, size in _cache_conn.execute(
+        "SELECT key, size FROM responses ORDER BY last_used"
+    ).fetchall():
+        if _cache_total_bytes <= target:
+            break
+        _cache_conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        _cache_total_bytes -= size
@@ -1,3 +1,6 @@
+import os
+import json
+import hashlib
 import sqlite3
 import pymysql
 import psycopg2
@@ -257,7 +260,7 @@ def generate_schema_prompt_postgresql(db_path):
     return schema_prompt
 
 
-def generate_schema_prompt(sql_dialect, db_path=None, num_rows=None):
+def build_schema_prompt(sql_dialect, db_path=None, num_rows=None):
     if sql_dialect == "SQLite":
         return generate_schema_prompt_sqlite(db_path, num_rows)
     elif sql_dialect == "MySQL":
@@ -266,3 +269,77 @@ def generate_schema_prompt(sql_dialect, db_path=None, num_rows=None):
         return generate_schema_prompt_postgresql(db_path)
     else:
         raise ValueError("Unsupported SQL dialect: {}".format(sql_dialect))
+
+
+# Schema prompts built by this process, keyed by (sql_dialect, db_id, num_rows)
+_schema_prompt_cache = {}
+# Directory of the on-disk schema prompt cache, empty to keep prompts in memory only
+schema_cache_dir = ""
+
+
+def set_schema_cache_dir(path):
+    global schema_cache_dir
+    schema_cache_dir = path or ""
+
+
+def database_signature(sql_dialect, db_path):
+    """
+    Identify the version of a SQLite database file from its size, mtime and
+    100-byte header. Server databases have no file to look at, so None is
+    returned and their prompts are only cached in memory.
+    """
+    if sql_dialect != "SQLite" or not db_path or not os.path.isfile(db_path):
+        return None
+    stat = os.stat(db_path)
+    with open(db_path, "rb") as db_file:
+        header = db_file.read(100)
+    return "{}-{}-{}".format(
+        stat.st_size, stat.st_mtime_ns, hashlib.sha1(header).hexdigest()
+    )
+
+
+def load_cached_schema_prompt(cache_file, signature):
+    try:
+        with open(cache_file, "r") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get("signature") != signature:
+        return None
+    return entry.get("prompt")
+
+
+def store_cached_schema_prompt(cache_file, signature, prompt):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # write to a temporary file first so concurrent readers never see half a prompt
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump({"signature": signature, "prompt": prompt}, f)
+    os.replace(temp_file, cache_file)
+
+
+def generate_schema_prompt(sql_dialect, db_path=None, num_rows=None):
+    """
+    Return the schema prompt of a database, building it only once per
+    (sql_dialect, db_id, num_rows). With a schema_cache_dir, SQLite prompts
+    are also kept on disk and reused by later runs until the database file
+    changes.
+    """
+    db_id = db_path.split("/")[-1].split(".sqlite")[0] if db_path else None
+    key = (sql_dialect, db_id, num_rows)
+    if key in _schema_prompt_cache:
+        return _schema_prompt_cache[key]
+    signature = database_signature(sql_dialect, db_path) if schema_cache_dir else None
+    cache_file = None
+    schema_prompt = None
+    if signature is not None:
+        cache_file = os.path.join(
+            schema_cache_dir, "{}_{}_{}.json".format(sql_dialect, db_id, num_rows)
+        )
+        schema_prompt = load_cached_schema_prompt(cache_file, signature)
+    if schema_prompt is None:
+        schema_prompt = build_schema_prompt(sql_dialect, db_path, num_rows)
+        if cache_file is not None:
+            store_cached_schema_prompt(cache_file, signature, schema_prompt)
+    _schema_prompt_cache[key] = schema_prompt
+    return schema_prompt